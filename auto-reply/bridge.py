@@ -2,37 +2,64 @@
 # ABOUTME: Sends text messages, files, and audio through the bridge on port 8082.
 
 import asyncio
+from typing import Optional
 import aiohttp
+import orjson
 import structlog
 
 logger = structlog.get_logger("bridge")
 
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
 
 class BridgeClient:
-    def __init__(self, base_url: str = "http://localhost:8082/api", timeout: int = 10):
+    def __init__(self, base_url: str = "http://localhost:8082/api", timeout: int = 10,
+                 concurrency: int = 4):
         self.base_url = base_url
         self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._send_sem = asyncio.Semaphore(concurrency)
+
+    async def __aenter__(self) -> "BridgeClient":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    async def _session_get(self) -> aiohttp.ClientSession:
+        # One pooled session per client so chunked replies reuse keep-alive connections
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=self.timeout,
+                connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=75),
+            )
+        return self._session
+
+    async def aclose(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
 
     async def send_message(self, recipient: str, message: str) -> tuple[bool, str]:
         url = f"{self.base_url}/send"
         payload = {"recipient": recipient, "message": message}
 
         try:
-            async with aiohttp.ClientSession(timeout=self.timeout) as session:
-                async with session.post(url, json=payload) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        success = data.get("success", False)
-                        msg = data.get("message", "Unknown response")
-                        if success:
-                            logger.info("message_sent", recipient=recipient, length=len(message))
-                        else:
-                            logger.error("message_send_failed", recipient=recipient, error=msg)
-                        return success, msg
+            session = await self._session_get()
+            async with session.post(url, data=orjson.dumps(payload), headers=_JSON_HEADERS) as resp:
+                if resp.status == 200:
+                    data = orjson.loads(await resp.read())
+                    success = data.get("success", False)
+                    msg = data.get("message", "Unknown response")
+                    if success:
+                        logger.info("message_sent", recipient=recipient, length=len(message))
                     else:
-                        text = await resp.text()
-                        logger.error("bridge_http_error", status=resp.status, body=text[:200])
-                        return False, f"HTTP {resp.status}: {text}"
+                        logger.error("message_send_failed", recipient=recipient, error=msg)
+                    return success, msg
+                else:
+                    text = await resp.text()
+                    logger.error("bridge_http_error", status=resp.status, body=text[:200])
+                    return False, f"HTTP {resp.status}: {text}"
 
         except aiohttp.ClientConnectorError:
             logger.error("bridge_connection_failed", url=url)
@@ -46,39 +73,43 @@ class BridgeClient:
         payload = {"recipient": recipient, "message": caption, "media_path": file_path}
 
         try:
-            async with aiohttp.ClientSession(timeout=self.timeout) as session:
-                async with session.post(url, json=payload) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        success = data.get("success", False)
-                        msg = data.get("message", "")
-                        if success:
-                            logger.info("file_sent", recipient=recipient, path=file_path)
-                        return success, msg
-                    else:
-                        text = await resp.text()
-                        return False, f"HTTP {resp.status}: {text}"
+            session = await self._session_get()
+            async with session.post(url, data=orjson.dumps(payload), headers=_JSON_HEADERS) as resp:
+                if resp.status == 200:
+                    data = orjson.loads(await resp.read())
+                    success = data.get("success", False)
+                    msg = data.get("message", "")
+                    if success:
+                        logger.info("file_sent", recipient=recipient, path=file_path)
+                    return success, msg
+                else:
+                    text = await resp.text()
+                    return False, f"HTTP {resp.status}: {text}"
         except Exception as e:
             logger.error("file_send_error", error=str(e))
             return False, str(e)
 
     async def send_chunked(self, recipient: str, chunks: list[str],
-                           delay: float = 0.5) -> list[tuple[bool, str]]:
+                           delay: float = 0) -> list[tuple[bool, str]]:
+        # Awaiting each ack before the next send is what keeps the chunks in
+        # order on the recipient's phone; the semaphore only bounds how many
+        # recipients are being sent to at once, never chunks of one reply
         results = []
         for i, chunk in enumerate(chunks):
-            success, msg = await self.send_message(recipient, chunk)
+            if i and delay:
+                await asyncio.sleep(delay)
+            async with self._send_sem:
+                success, msg = await self.send_message(recipient, chunk)
             results.append((success, msg))
             if not success:
                 logger.error("chunked_send_failed", chunk_index=i, error=msg)
                 break
-            if i < len(chunks) - 1:
-                await asyncio.sleep(delay)
         return results
 
     async def health_check(self) -> bool:
         try:
-            async with aiohttp.ClientSession(timeout=self.timeout) as session:
-                async with session.post(f"{self.base_url}/send", json={}) as resp:
-                    return resp.status in (200, 400, 405)
+            session = await self._session_get()
+            async with session.post(f"{self.base_url}/send", data=b"{}", headers=_JSON_HEADERS) as resp:
+                return resp.status in (200, 400, 405)
         except Exception:
             return False
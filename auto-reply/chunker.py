@@ -6,6 +6,8 @@ import structlog
 
 logger = structlog.get_logger("chunker")
 
+_LAST_SENT_BREAK_RE = re.compile(r'.*[.!?]\s', re.DOTALL)
+
 
 class ResponseChunker:
     def __init__(self, max_length: int = 4096, min_length: int = 100):
@@ -21,53 +23,58 @@ class ResponseChunker:
         if len(text) <= self.max_length:
             return [text]
 
-        chunks = []
-        remaining = text
+        n = len(text)
 
-        while remaining:
-            if len(remaining) <= self.max_length:
-                chunks.append(remaining.strip())
-                break
+        # Fast path for replies just over the limit: a paragraph break found with a
+        # C-level rfind often yields both chunks without running the full scan.
+        if n <= self.max_length * 1.25:
+            pos = text.rfind("\n\n", self.min_length + 1, self.max_length)
+            if pos != -1:
+                tail = text[pos + 2:].lstrip()
+                if len(tail) <= self.max_length:
+                    chunks = [text[:pos].rstrip(), tail]
+                    logger.info("text_chunked", original_length=n, chunks=2)
+                    return chunks
 
-            split_pos = self._find_paragraph_break(remaining)
-
-            if split_pos is None:
-                split_pos = self._find_sentence_break(remaining)
+        chunks = []
+        start = 0
 
-            if split_pos is None:
-                split_pos = self._find_newline_break(remaining)
+        # Advance a cursor through text instead of re-slicing the remainder each pass
+        while start < n:
+            if n - start <= self.max_length:
+                chunks.append(text[start:])
+                break
 
-            if split_pos is None:
-                split_pos = self.max_length
+            split_pos = self._find_split(text, start)
 
-            chunk = remaining[:split_pos].strip()
+            chunk = text[start:split_pos].strip()
             if chunk:
                 chunks.append(chunk)
-            remaining = remaining[split_pos:].strip()
+            start = split_pos
+            while start < n and text[start].isspace():
+                start += 1
 
         logger.info("text_chunked", original_length=len(text), chunks=len(chunks))
         return chunks
 
-    def _find_paragraph_break(self, text: str) -> int | None:
-        search_area = text[:self.max_length]
-        pos = search_area.rfind("\n\n")
-        if pos > self.min_length:
+    def _find_split(self, text: str, start: int = 0) -> int:
+        # Search text[start:start + max_length] in place: str.rfind and Pattern.match
+        # take explicit bounds, so no window slice is ever copied. Returns an
+        # absolute index into text.
+        end = min(len(text), start + self.max_length)
+        floor = start + self.min_length
+
+        pos = text.rfind("\n\n", floor + 1, end)
+        if pos != -1:
             return pos + 2
-        return None
-
-    def _find_sentence_break(self, text: str) -> int | None:
-        search_area = text[:self.max_length]
-        matches = list(re.finditer(r'[.!?]\s', search_area))
-        if matches:
-            last_match = matches[-1]
-            pos = last_match.end()
-            if pos > self.min_length:
-                return pos
-        return None
-
-    def _find_newline_break(self, text: str) -> int | None:
-        search_area = text[:self.max_length]
-        pos = search_area.rfind("\n")
-        if pos > self.min_length:
+
+        # Greedy match pins the last sentence boundary in the window
+        m = _LAST_SENT_BREAK_RE.match(text, start, end)
+        if m and m.end() > floor:
+            return m.end()
+
+        pos = text.rfind("\n", floor + 1, end)
+        if pos != -1:
             return pos + 1
-        return None
+
+        return start + self.max_length
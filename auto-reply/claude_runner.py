@@ -2,9 +2,14 @@
 # ABOUTME: Each sender gets a persistent session via --resume, with full MCP access.
 
 import asyncio
-import json
+import functools
+import os
+import time
+from collections import deque
 from pathlib import Path
 from typing import Optional
+import aiofiles
+import orjson
 import structlog
 
 logger = structlog.get_logger("claude-runner")
@@ -35,6 +40,7 @@ DEFAULT_ALLOWED_TOOLS = [
     "mcp__github__list_commits",
     "mcp__github__list_pull_requests",
 ]
+PERPLEXITY_TOOLS = frozenset(t for t in DEFAULT_ALLOWED_TOOLS if "perplexity" in t)
 
 # Tools explicitly blocked — no write/execute operations from WhatsApp
 DEFAULT_DISALLOWED_TOOLS = [
@@ -63,6 +69,57 @@ DEFAULT_DISALLOWED_TOOLS = [
     "mcp__supabase__rebase_*",
 ]
 
+# Only a short stderr prefix is ever logged, so that is all we buffer
+STDERR_CAPTURE_BYTES = 4096
+
+_SYSTEM_APPEND_SUFFIX = (
+    "Keep your response concise and conversational: "
+    "aim for 1-3 short sentences unless the question genuinely needs more. "
+    "No markdown formatting."
+)
+
+
+@functools.lru_cache(maxsize=1024)
+def system_append_for(sender_name: str) -> str:
+    return f"You are chatting with {sender_name or 'someone'} on WhatsApp. {_SYSTEM_APPEND_SUFFIX}"
+
+
+class AIMDLimiter:
+    """Concurrency cap for CLI runs, tuned by additive-increase/multiplicative-decrease.
+
+    While the recent mean latency stays under target the limit grows by one per
+    call; a timeout or a slow window halves it.
+    """
+
+    def __init__(self, maximum: int = 4, minimum: int = 1,
+                 target_latency: float = 60.0, window: int = 10):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = maximum
+        self.target_latency = target_latency
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._in_flight = 0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self) -> "AIMDLimiter":
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def record(self, latency: float, ok: bool = True):
+        self._latencies.append(latency)
+        mean = sum(self._latencies) / len(self._latencies)
+        if ok and mean <= self.target_latency:
+            self.limit = min(self.maximum, self.limit + 1)
+        else:
+            self.limit = max(self.minimum, self.limit // 2)
+
 
 class ClaudeRunner:
     def __init__(
@@ -74,6 +131,9 @@ class ClaudeRunner:
         allowed_tools: Optional[list[str]] = None,
         disallowed_tools: Optional[list[str]] = None,
         mcp_config: Optional[str] = None,
+        save_debounce: float = 0.5,
+        max_concurrency: int = 4,
+        max_requests_per_minute: int = 0,
     ):
         self.workspace_dir = str(Path(workspace_dir).resolve())
         self.model = model
@@ -82,134 +142,246 @@ class ClaudeRunner:
         self.allowed_tools = allowed_tools or DEFAULT_ALLOWED_TOOLS
         self.disallowed_tools = disallowed_tools or DEFAULT_DISALLOWED_TOOLS
         self.mcp_config = mcp_config
+        self.save_debounce = save_debounce
+        self._limiter = AIMDLimiter(maximum=max_concurrency, target_latency=timeout / 2)
+        # Sliding one-minute window of CLI start times; 0 disables the gate
+        self.max_requests_per_minute = max_requests_per_minute
+        self._request_times: deque[float] = deque()
+
+        # argv pieces that never change between calls are built once
+        self._allowed_tools_arg = ",".join(self.allowed_tools) if self.allowed_tools else None
+        self._disallowed_tools_arg = ",".join(self.disallowed_tools) if self.disallowed_tools else None
+        self._base_cmd = [
+            "claude",
+            "-p",
+            "--output-format", "json",
+            "--model", self.model,
+            "--max-turns", str(self.max_turns),
+        ]
+        self._tool_args: list[str] = []
+        if self._allowed_tools_arg:
+            self._tool_args.extend(["--allowedTools", self._allowed_tools_arg])
+        if self._disallowed_tools_arg:
+            self._tool_args.extend(["--disallowedTools", self._disallowed_tools_arg])
+        if self.mcp_config:
+            self._tool_args.extend(["--mcp-config", self.mcp_config])
 
         # Persistent mapping: sender_jid -> claude session_id
         self._session_map: dict[str, str] = {}
         self._session_map_path = Path(workspace_dir) / ".session_map.json"
+        self._save_lock = asyncio.Lock()
+        # Session updates are coalesced: writers set the event, one loop flushes
+        self._save_pending = asyncio.Event()
+        self._save_task: Optional[asyncio.Task] = None
+        # Bumped per update and recorded once a write lands, so a cancelled
+        # write still leaves the map marked as unsaved
+        self._map_version = 0
+        self._saved_version = 0
         self._load_session_map()
 
     def _load_session_map(self):
-        if self._session_map_path.exists():
-            with open(self._session_map_path) as f:
-                self._session_map = json.load(f)
-            logger.info("session_map_loaded", count=len(self._session_map))
-
-    def _save_session_map(self):
-        self._session_map_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(self._session_map_path, "w") as f:
-            json.dump(self._session_map, f, indent=2)
+        try:
+            data = self._session_map_path.read_bytes()
+        except FileNotFoundError:
+            return
+        if not data.strip():
+            return
+        self._session_map = orjson.loads(data)
+        logger.info("session_map_loaded", count=len(self._session_map))
+
+    async def _save_session_map(self):
+        # Write to a temp file and swap it in so a crash never leaves a torn map
+        async with self._save_lock:
+            version = self._map_version
+            self._session_map_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self._session_map_path.with_suffix(".tmp")
+            async with aiofiles.open(tmp_path, "wb") as f:
+                await f.write(orjson.dumps(self._session_map))
+            os.replace(tmp_path, self._session_map_path)
+            self._saved_version = version
+
+    def _schedule_save(self):
+        self._map_version += 1
+        self._save_pending.set()
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.create_task(self._save_loop())
+
+    async def _save_loop(self):
+        while True:
+            await self._save_pending.wait()
+            await asyncio.sleep(self.save_debounce)
+            self._save_pending.clear()
+            await self._save_session_map()
+
+    async def aclose(self):
+        """Stop the background writer and flush any pending session map update."""
+        if self._save_task is not None:
+            self._save_task.cancel()
+            try:
+                await self._save_task
+            except asyncio.CancelledError:
+                pass
+            self._save_task = None
+        await self._flush_now()
+
+    async def _flush_now(self):
+        # Write the map only if it changed since the last completed write
+        self._save_pending.clear()
+        if self._map_version != self._saved_version:
+            await self._save_session_map()
+
+    @staticmethod
+    async def _communicate(proc: asyncio.subprocess.Process,
+                           input_bytes: bytes) -> tuple[bytes, bytes]:
+        # Like proc.communicate(), but only the head of stderr is kept in memory
+        async def feed_stdin():
+            try:
+                proc.stdin.write(input_bytes)
+                await proc.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            proc.stdin.close()
+
+        async def read_stderr_head() -> bytes:
+            head = bytearray()
+            while chunk := await proc.stderr.read(65536):
+                if len(head) < STDERR_CAPTURE_BYTES:
+                    head += chunk[:STDERR_CAPTURE_BYTES - len(head)]
+            return bytes(head)
+
+        _, stdout, stderr, _ = await asyncio.gather(
+            feed_stdin(), proc.stdout.read(), read_stderr_head(), proc.wait(),
+        )
+        return stdout, stderr
+
+    async def wait_if_throttled(self):
+        """Block until starting another CLI run stays within max_requests_per_minute."""
+        if self.max_requests_per_minute <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            while self._request_times and now - self._request_times[0] >= 60:
+                self._request_times.popleft()
+            if len(self._request_times) < self.max_requests_per_minute:
+                self._request_times.append(now)
+                return
+            wait = 60 - (now - self._request_times[0])
+            logger.info("claude_throttled", wait=round(wait, 1))
+            await asyncio.sleep(wait)
 
     def get_session_id(self, sender_jid: str) -> Optional[str]:
         return self._session_map.get(sender_jid)
 
-    def clear_session(self, sender_jid: str):
+    async def clear_session(self, sender_jid: str):
         if sender_jid in self._session_map:
             del self._session_map[sender_jid]
-            self._save_session_map()
+            # Debounced like any other change, so a stale-session retry writes
+            # the cleared and the fresh id in one go
+            self._schedule_save()
             logger.info("session_cleared", sender=sender_jid)
 
     async def generate_reply(self, sender_jid: str, message: str,
                               sender_name: str = "") -> str:
         session_id = self._session_map.get(sender_jid)
+        msg_bytes = message.encode("utf-8")
 
-        cmd = [
-            "claude",
-            "-p",
-            "--output-format", "json",
-            "--model", self.model,
-            "--max-turns", str(self.max_turns),
-        ]
-
-        if session_id:
-            cmd.extend(["--resume", session_id])
-
-        if self.allowed_tools:
-            cmd.extend(["--allowedTools", ",".join(self.allowed_tools)])
-
-        if self.disallowed_tools:
-            cmd.extend(["--disallowedTools", ",".join(self.disallowed_tools)])
+        # Everything after the optional --resume is the same for both attempts;
+        # the sender context goes in as a system prompt appendix
+        tail_args = [*self._tool_args, "--append-system-prompt", system_append_for(sender_name)]
 
-        if self.mcp_config:
-            cmd.extend(["--mcp-config", self.mcp_config])
-
-        # Add sender context as system prompt appendix
-        system_append = (
-            f"You are chatting with {sender_name or 'someone'} on WhatsApp. "
-            "Keep your response concise and conversational. "
-            "No markdown formatting."
-        )
-        cmd.extend(["--append-system-prompt", system_append])
+        # At most two attempts: a stale --resume session is retried once without it
+        for _attempt in range(2):
+            cmd = list(self._base_cmd)
+            if session_id:
+                cmd.extend(["--resume", session_id])
+            cmd.extend(tail_args)
 
-        logger.info("claude_spawning",
-            sender=sender_jid,
-            session_id=session_id or "new",
-            model=self.model,
-            max_turns=self.max_turns)
-
-        try:
-            proc = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdin=asyncio.subprocess.PIPE,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
-                cwd=self.workspace_dir,
-            )
-
-            stdout, stderr = await asyncio.wait_for(
-                proc.communicate(input=message.encode("utf-8")),
-                timeout=self.timeout,
-            )
-
-            if proc.returncode != 0:
-                stderr_text = stderr.decode("utf-8", errors="replace")[:500]
-                logger.error("claude_exit_error",
-                    returncode=proc.returncode,
-                    stderr=stderr_text,
-                    sender=sender_jid)
-
-                # If resume failed (stale session), retry without --resume
-                if session_id and "session" in stderr_text.lower():
-                    logger.info("claude_retrying_without_resume", sender=sender_jid)
-                    self.clear_session(sender_jid)
-                    return await self.generate_reply(sender_jid, message, sender_name)
-
-                return "I'm having trouble processing your message right now. Please try again."
-
-            stdout_text = stdout.decode("utf-8", errors="replace")
-            result = json.loads(stdout_text)
+            logger.info("claude_spawning",
+                sender=sender_jid,
+                session_id=session_id or "new",
+                model=self.model,
+                max_turns=self.max_turns)
+
+            proc = None
+            try:
+                await self.wait_if_throttled()
+                async with self._limiter:
+                    started = time.monotonic()
+                    proc = await asyncio.create_subprocess_exec(
+                        *cmd,
+                        stdin=asyncio.subprocess.PIPE,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE,
+                        cwd=self.workspace_dir,
+                    )
+
+                    try:
+                        stdout, stderr = await asyncio.wait_for(
+                            self._communicate(proc, msg_bytes),
+                            timeout=self.timeout,
+                        )
+                    except asyncio.TimeoutError:
+                        self._limiter.record(time.monotonic() - started, ok=False)
+                        raise
+                    # A non-zero exit (stale --resume, prompt errors) is about one
+                    # sender's request, not CLI overload, so only latency counts
+                    self._limiter.record(time.monotonic() - started)
+
+                if proc.returncode != 0:
+                    stderr_text = stderr.decode("utf-8", errors="replace")[:500]
+                    logger.error("claude_exit_error",
+                        returncode=proc.returncode,
+                        stderr=stderr_text,
+                        sender=sender_jid)
+
+                    # If resume failed (stale session), retry without --resume
+                    if session_id and "session" in stderr_text.lower():
+                        logger.info("claude_retrying_without_resume", sender=sender_jid)
+                        await self.clear_session(sender_jid)
+                        session_id = None
+                        continue
+
+                    return "I'm having trouble processing your message right now. Please try again."
+
+                result = orjson.loads(stdout)
+
+                reply = result.get("result", "")
+                new_session_id = result.get("session_id", "")
+
+                if new_session_id:
+                    self._session_map[sender_jid] = new_session_id
+                    self._schedule_save()
+                    logger.info("claude_session_stored",
+                        sender=sender_jid,
+                        session_id=new_session_id)
+
+                logger.info("claude_reply_generated",
+                    sender=sender_jid,
+                    reply_length=len(reply),
+                    session_id=new_session_id or session_id)
 
-            reply = result.get("result", "")
-            new_session_id = result.get("session_id", "")
+                return reply
 
-            if new_session_id:
-                self._session_map[sender_jid] = new_session_id
-                self._save_session_map()
-                logger.info("claude_session_stored",
+            except asyncio.TimeoutError:
+                if proc is not None and proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                logger.error("claude_timeout",
                     sender=sender_jid,
-                    session_id=new_session_id)
+                    timeout=self.timeout)
+                return "Sorry, I took too long thinking about that. Please try a simpler question."
 
-            logger.info("claude_reply_generated",
-                sender=sender_jid,
-                reply_length=len(reply),
-                session_id=new_session_id or session_id)
-
-            return reply
+            except orjson.JSONDecodeError as e:
+                logger.error("claude_json_parse_error",
+                    error=str(e),
+                    sender=sender_jid,
+                    stdout_preview=stdout[:200].decode("utf-8", errors="replace"))
+                return "I had trouble processing my response. Please try again."
 
-        except asyncio.TimeoutError:
-            logger.error("claude_timeout",
-                sender=sender_jid,
-                timeout=self.timeout)
-            return "Sorry, I took too long thinking about that. Please try a simpler question."
+            except Exception as e:
+                logger.error("claude_unexpected_error",
+                    error=str(e),
+                    sender=sender_jid)
+                return "Something went wrong. Please try again later."
 
-        except json.JSONDecodeError as e:
-            logger.error("claude_json_parse_error",
-                error=str(e),
-                sender=sender_jid,
-                stdout_preview=stdout_text[:200] if 'stdout_text' in dir() else "N/A")
-            return "I had trouble processing my response. Please try again."
-
-        except Exception as e:
-            logger.error("claude_unexpected_error",
-                error=str(e),
-                sender=sender_jid)
-            return "Something went wrong. Please try again later."
+        return "I'm having trouble processing your message right now. Please try again."
@@ -5,6 +5,15 @@ from pydantic import BaseModel
 from pathlib import Path
 import yaml
 import os
+import re
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# Splits and trims a comma-separated env value in one pass
+_RECIPIENT_SPLIT_RE = re.compile(r"\s*,\s*")
 
 
 class BridgeConfig(BaseModel):
@@ -26,6 +35,8 @@ class ClaudeConfig(BaseModel):
     timeout: int = 120
     workspace_dir: str = "workspace"
     mcp_config: str = ""
+    max_concurrency: int = 4
+    max_requests_per_minute: int = 0
 
 
 class SessionConfig(BaseModel):
@@ -65,15 +76,15 @@ def load_config(config_path: str = "config.yaml") -> AutoReplyConfig:
     config_data = {}
     if Path(config_path).exists():
         with open(config_path) as f:
-            config_data = yaml.safe_load(f) or {}
+            config_data = yaml.load(f, Loader=SafeLoader) or {}
 
     config = AutoReplyConfig(**config_data)
 
     # Override allowed recipients from env
     allowed_raw = os.environ.get("WHATSAPP_MCP_ALLOWED_RECIPIENT", "")
     if allowed_raw:
-        config.security.allowed_recipients = [
-            jid.strip() for jid in allowed_raw.split(",") if jid.strip()
-        ]
+        config.security.allowed_recipients = list(
+            filter(None, _RECIPIENT_SPLIT_RE.split(allowed_raw.strip()))
+        )
 
     return config
@@ -4,10 +4,13 @@
 import asyncio
 import os
 import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, suppress
 from datetime import datetime
-from collections import defaultdict
+import orjson
 import structlog
 from aiohttp import web
+from pydantic import BaseModel
 
 from config import load_config
 from pairing import PairingStore, ContactStatus
@@ -17,6 +20,33 @@ from bridge import BridgeClient
 
 logger = structlog.get_logger("auto-reply")
 
+# Per-sender bookkeeping idle longer than this is dropped by the GC sweep
+SENDER_IDLE_SECONDS = 3600
+GC_INTERVAL_SECONDS = 300
+
+# Webhook redeliveries of the same message_id inside this window are dropped
+SEEN_MESSAGE_TTL_SECONDS = 300
+MAX_SEEN_MESSAGES = 4096
+
+
+class WebhookPayload(BaseModel):
+    """Incoming message notification; mirrors WebhookPayload in the Go bridge."""
+    message_id: str = ""
+    chat_jid: str = ""
+    sender_jid: str = ""
+    sender_name: str = ""
+    content: str = ""
+    timestamp: str = ""
+    is_from_me: bool = False
+    is_group: bool = False
+    media_type: str = ""
+    filename: str = ""
+
+
+def json_response(data: dict, status: int = 200) -> web.Response:
+    return web.Response(body=orjson.dumps(data), status=status,
+                        content_type="application/json")
+
 
 class AutoReplyDaemon:
     def __init__(self, config_path: str = "config.yaml"):
@@ -24,6 +54,8 @@ class AutoReplyDaemon:
         self.app = web.Application()
         self.app.router.add_post("/webhook/message", self.handle_webhook)
         self.app.router.add_get("/health", self.handle_health)
+        self.app.on_startup.append(self._on_startup)
+        self.app.on_cleanup.append(self._on_cleanup)
 
         # Initialize components
         self.pairing = PairingStore(
@@ -37,6 +69,8 @@ class AutoReplyDaemon:
             max_turns=self.config.claude.max_turns,
             timeout=self.config.claude.timeout,
             mcp_config=self.config.claude.mcp_config or None,
+            max_concurrency=self.config.claude.max_concurrency,
+            max_requests_per_minute=self.config.claude.max_requests_per_minute,
         )
         self.chunker = ResponseChunker(
             max_length=self.config.security.max_message_length
@@ -46,11 +80,16 @@ class AutoReplyDaemon:
             timeout=self.config.bridge.send_timeout
         )
 
-        # Rate limiting: track last reply time per sender
-        self._last_reply_time: dict[str, float] = defaultdict(float)
+        # Rate limiting: track last reply time per sender (time.monotonic() values)
+        self._last_reply_mono: dict[str, float] = {}
+
+        # Processing lock per sender (sequential message processing), with the
+        # number of coroutines holding or waiting on it; dropped when that hits 0
+        self._sender_locks: dict[str, tuple[asyncio.Lock, int]] = {}
+        self._gc_task: asyncio.Task | None = None
 
-        # Processing lock per sender (sequential message processing)
-        self._sender_locks: dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        # Recently accepted message_ids, oldest first (time.monotonic() values)
+        self._seen_ids: OrderedDict[str, float] = OrderedDict()
 
         # Webhook secret for authentication
         self._webhook_secret = os.environ.get("AUTOREPLY_WEBHOOK_SECRET", "")
@@ -62,31 +101,52 @@ class AutoReplyDaemon:
             received_secret = request.headers.get("X-Webhook-Secret", "")
             if received_secret != self._webhook_secret:
                 logger.warning("[SECURITY] Invalid webhook secret")
-                return web.json_response({"status": "unauthorized"}, status=401)
+                return json_response({"status": "unauthorized"}, status=401)
 
         try:
-            payload = await request.json()
+            # Parses and validates in a single pass in pydantic-core
+            payload = WebhookPayload.model_validate_json(await request.read())
+
+            message_id = payload.message_id
+            if message_id and self._is_duplicate(message_id):
+                logger.info("webhook_duplicate", message_id=message_id)
+                return json_response({"status": "duplicate"})
+
             logger.info("webhook_received",
-                message_id=payload.get("message_id"),
-                sender=payload.get("sender_jid"),
-                content_preview=payload.get("content", "")[:50])
+                message_id=message_id,
+                sender=payload.sender_jid,
+                content_preview=payload.content[:50])
 
             # Process message asynchronously
             asyncio.create_task(self.process_message(payload))
-            return web.json_response({"status": "accepted"})
+            return json_response({"status": "accepted"})
 
         except Exception as e:
             logger.error("webhook_error", error=str(e))
-            return web.json_response({"status": "error", "detail": str(e)}, status=400)
-
-    async def process_message(self, payload: dict):
+            return json_response({"status": "error", "detail": str(e)}, status=400)
+
+    def _is_duplicate(self, message_id: str) -> bool:
+        """Record message_id and report whether it was already seen recently."""
+        now = time.monotonic()
+        while self._seen_ids:
+            oldest_id, seen_at = next(iter(self._seen_ids.items()))
+            if now - seen_at <= SEEN_MESSAGE_TTL_SECONDS and len(self._seen_ids) < MAX_SEEN_MESSAGES:
+                break
+            self._seen_ids.popitem(last=False)
+
+        if message_id in self._seen_ids:
+            return True
+        self._seen_ids[message_id] = now
+        return False
+
+    async def process_message(self, payload: WebhookPayload):
         """Main message processing pipeline."""
-        sender_jid = payload.get("sender_jid", "")
-        content = payload.get("content", "")
-        is_from_me = payload.get("is_from_me", False)
-        is_group = payload.get("is_group", False)
-        sender_name = payload.get("sender_name", "")
-        media_type = payload.get("media_type", "")
+        sender_jid = payload.sender_jid
+        content = payload.content
+        is_from_me = payload.is_from_me
+        is_group = payload.is_group
+        sender_name = payload.sender_name
+        media_type = payload.media_type
 
         # ── Security checks ──────────────────────────────────
         if is_from_me:
@@ -97,19 +157,35 @@ class AutoReplyDaemon:
             return
 
         # ── Rate limiting ─────────────────────────────────────
-        now = time.time()
-        last = self._last_reply_time.get(sender_jid, 0)
-        if now - last < self.config.security.rate_limit_seconds:
+        now = time.monotonic()
+        last = self._last_reply_mono.get(sender_jid)
+        if last is not None and now - last < self.config.security.rate_limit_seconds:
             logger.info("rate_limited", sender=sender_jid,
                 wait=round(self.config.security.rate_limit_seconds - (now - last), 1))
             return
 
         # ── Sequential processing per sender ──────────────────
-        async with self._sender_locks[sender_jid]:
+        async with self._sender_lock(sender_jid):
             await self._process_message_locked(
                 sender_jid, content, sender_name, media_type
             )
 
+    @asynccontextmanager
+    async def _sender_lock(self, sender_jid: str):
+        lock, refs = self._sender_locks.get(sender_jid, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._sender_locks[sender_jid] = (lock, refs + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, refs = self._sender_locks[sender_jid]
+            if refs <= 1:
+                del self._sender_locks[sender_jid]
+            else:
+                self._sender_locks[sender_jid] = (lock, refs - 1)
+
     async def _process_message_locked(self, sender_jid: str, content: str,
                                        sender_name: str, media_type: str):
         """Process a message with per-sender lock held."""
@@ -132,7 +208,7 @@ class AutoReplyDaemon:
                     f"This code expires in {self.config.pairing.code_expiry_minutes} minutes."
                 )
                 await self.bridge.send_message(sender_jid, pairing_msg)
-                self._last_reply_time[sender_jid] = time.time()
+                self._last_reply_mono[sender_jid] = time.monotonic()
                 return
 
             if status == ContactStatus.PENDING:
@@ -140,7 +216,7 @@ class AutoReplyDaemon:
                     "Your pairing request is still pending approval. "
                     "Please wait for the account owner to approve your code."
                 )
-                self._last_reply_time[sender_jid] = time.time()
+                self._last_reply_mono[sender_jid] = time.monotonic()
                 return
 
         # ── Handle media messages ─────────────────────────────
@@ -163,8 +239,9 @@ class AutoReplyDaemon:
         chunks = self.chunker.chunk(reply)
         results = await self.bridge.send_chunked(sender_jid, chunks)
 
-        any_success = any(success for success, _ in results)
-        self._last_reply_time[sender_jid] = time.time()
+        # send_chunked stops at the first failure, so only the first result matters
+        any_success = bool(results) and results[0][0]
+        self._last_reply_mono[sender_jid] = time.monotonic()
 
         logger.info("reply_sent",
             sender=sender_jid,
@@ -173,9 +250,34 @@ class AutoReplyDaemon:
             session_id=self.claude.get_session_id(sender_jid),
             success=any_success)
 
+    def _prune_idle_senders(self, now: float):
+        """Drop rate-limit timestamps for senders not seen recently."""
+        for jid, ts in list(self._last_reply_mono.items()):
+            if now - ts > SENDER_IDLE_SECONDS:
+                del self._last_reply_mono[jid]
+
+    async def _gc_loop(self):
+        while True:
+            await asyncio.sleep(GC_INTERVAL_SECONDS)
+            self._prune_idle_senders(time.monotonic())
+
+    async def _on_startup(self, app: web.Application):
+        self._gc_task = asyncio.create_task(self._gc_loop())
+
+    async def _on_cleanup(self, app: web.Application):
+        # Let the sweep finish cancelling before the resources it uses close
+        if self._gc_task is not None:
+            self._gc_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._gc_task
+            self._gc_task = None
+        await self.bridge.aclose()
+        await self.claude.aclose()
+        self.pairing.close()
+
     async def handle_health(self, request: web.Request) -> web.Response:
         bridge_ok = await self.bridge.health_check()
-        return web.json_response({
+        return json_response({
             "status": "ok" if bridge_ok else "degraded",
             "version": "0.2.0",
             "bridge_connected": bridge_ok,
@@ -198,6 +300,14 @@ def main():
         pairing_enabled=config.pairing.enabled,
         allowed_recipients=config.security.allowed_recipients)
 
+    try:
+        import uvloop
+        # uvloop.install() is deprecated on Python 3.12+; the policy works on 3.11 too
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("event_loop", implementation="uvloop")
+    except ImportError:
+        pass
+
     web.run_app(
         daemon.app,
         host=config.daemon.host,
@@ -1,14 +1,19 @@
 # ABOUTME: Pairing-based access control for the WhatsApp auto-reply daemon.
 # ABOUTME: Manages contact approval flow: unknown -> pending (code sent) -> approved.
 
+import queue
 import sqlite3
 import secrets
 import sys
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
 from pathlib import Path
 from enum import Enum
 from dataclasses import dataclass
-from typing import Optional
+from typing import Callable, Iterable, Optional
 import structlog
 
 logger = structlog.get_logger("pairing")
@@ -31,39 +36,169 @@ class Contact:
     name: Optional[str] = None
 
 
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+# Timestamp columns hold ISO-8601 text (our isoformat() or SQLite's
+# CURRENT_TIMESTAMP). Queries opt in per column with an
+# `AS "col [pairing_ts]"` alias, so the converter's private name never
+# applies to other sqlite3 connections; legacy empty strings decode as None
+sqlite3.register_converter(
+    "pairing_ts", lambda value: datetime.fromisoformat(value.decode()) if value else None)
+_CONTACT_COLUMNS = (
+    'jid, status, pairing_code, code_expires_epoch, approved_at AS "approved_at [pairing_ts]", name'
+)
+
+
+# Approvals are rare, so settled statuses are served from memory. In-process
+# mutations invalidate immediately; a commit from another process (the pairing
+# CLI) is noticed via PRAGMA data_version at most this many seconds later
+STATUS_CACHE_TTL_SECONDS = 5.0
+STATUS_CACHE_MAX_ENTRIES = 1024
+
+
+class _Pool:
+    """One writer plus a fixed set of reader connections, opened once and reused."""
+
+    def __init__(self, db_path: str, readers: int = 2):
+        self._writer = self._connect(db_path)
+        self._write_lock = threading.Lock()
+        self._readers: queue.Queue[sqlite3.Connection] = queue.Queue()
+        # Every ":memory:" connection is its own database, so reads share the writer
+        self._shared = db_path == ":memory:"
+        if not self._shared:
+            for _ in range(readers):
+                self._readers.put(self._connect(db_path))
+
+    @staticmethod
+    def _connect(db_path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False,
+                               detect_types=sqlite3.PARSE_COLNAMES)
+        for pragma in _PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def read(self):
+        if self._shared:
+            with self._write_lock:
+                yield self._writer
+            return
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    @contextmanager
+    def write(self):
+        with self._write_lock:
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._writer
+            except BaseException:
+                self._writer.execute("ROLLBACK")
+                raise
+            self._writer.execute("COMMIT")
+
+    def data_version(self) -> int:
+        # Changes whenever another connection, e.g. the pairing CLI, commits
+        with self._write_lock:
+            return self._writer.execute("PRAGMA data_version").fetchone()[0]
+
+    def close(self):
+        self._writer.close()
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+
+
 class PairingStore:
     def __init__(self, db_path: str = "store/pairing.db",
-                 code_expiry_minutes: int = 10, code_length: int = 6):
+                 code_expiry_minutes: int = 10, code_length: int = 6,
+                 now_fn: Callable[[], float] = time.time):
         self.db_path = db_path
         self.code_expiry_minutes = code_expiry_minutes
         self.code_length = code_length
+        # Epoch-seconds clock for code expiry; tests inject a fake one
+        self._now = now_fn
+        # A single draw from [0, 10^n) is uniform over all n-digit codes
+        self._code_modulus = 10 ** code_length
         Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._pool = _Pool(db_path)
+        self._status_cache: OrderedDict[str, ContactStatus] = OrderedDict()
+        self._cache_data_version = self._pool.data_version()
+        self._cache_checked_at = time.monotonic()
         self._init_db()
 
+    def _read(self):
+        return self._pool.read()
+
+    def _write(self):
+        return self._pool.write()
+
+    def close(self):
+        self._pool.close()
+
+    def _cached_status(self, jid: str) -> Optional[ContactStatus]:
+        if not self._status_cache:
+            return None
+        now = time.monotonic()
+        if now - self._cache_checked_at >= STATUS_CACHE_TTL_SECONDS:
+            # Hits inside the window never touch SQLite; once it lapses, one
+            # cheap pragma tells whether another process has committed since
+            self._cache_checked_at = now
+            version = self._pool.data_version()
+            if version != self._cache_data_version:
+                self._status_cache.clear()
+                self._cache_data_version = version
+                return None
+        status = self._status_cache.get(jid)
+        if status is not None:
+            self._status_cache.move_to_end(jid)
+        return status
+
+    def _cache_status(self, jid: str, status: ContactStatus):
+        self._status_cache[jid] = status
+        self._status_cache.move_to_end(jid)
+        while len(self._status_cache) > STATUS_CACHE_MAX_ENTRIES:
+            self._status_cache.popitem(last=False)
+
     def _init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS contacts (
-                jid TEXT PRIMARY KEY,
-                status TEXT NOT NULL DEFAULT 'unknown',
-                pairing_code TEXT,
-                code_expires_at TIMESTAMP,
-                approved_at TIMESTAMP,
-                name TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        conn.commit()
-        conn.close()
+        with self._write() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS contacts (
+                    jid TEXT PRIMARY KEY,
+                    status TEXT NOT NULL DEFAULT 'unknown',
+                    pairing_code TEXT,
+                    code_expires_epoch INTEGER,
+                    approved_at TIMESTAMP,
+                    name TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(contacts)")}
+            if "code_expires_epoch" not in columns:
+                # Older databases stored expiry as local-time ISO text in code_expires_at
+                conn.execute("ALTER TABLE contacts ADD COLUMN code_expires_epoch INTEGER")
+                conn.execute("""
+                    UPDATE contacts
+                    SET code_expires_epoch = CAST(strftime('%s', code_expires_at, 'utc') AS INTEGER)
+                    WHERE code_expires_at IS NOT NULL
+                """)
 
     def get_contact(self, jid: str) -> Contact:
-        conn = sqlite3.connect(self.db_path)
-        row = conn.execute(
-            "SELECT jid, status, pairing_code, code_expires_at, approved_at, name FROM contacts WHERE jid = ?",
-            (jid,)
-        ).fetchone()
-        conn.close()
+        with self._read() as conn:
+            row = conn.execute(
+                f"SELECT {_CONTACT_COLUMNS} FROM contacts WHERE jid = ?",
+                (jid,)
+            ).fetchone()
 
         if not row:
             return Contact(jid=jid, status=ContactStatus.UNKNOWN)
@@ -72,84 +207,90 @@ class PairingStore:
             jid=row[0],
             status=ContactStatus(row[1]),
             pairing_code=row[2],
-            code_expires_at=datetime.fromisoformat(row[3]) if row[3] else None,
-            approved_at=datetime.fromisoformat(row[4]) if row[4] else None,
+            code_expires_at=datetime.fromtimestamp(row[3]) if row[3] is not None else None,
+            approved_at=row[4],
             name=row[5]
         )
 
     def check_access(self, jid: str) -> ContactStatus:
-        contact = self.get_contact(jid)
-        if contact.status == ContactStatus.PENDING and contact.code_expires_at:
-            if datetime.now() > contact.code_expires_at:
+        cached = self._cached_status(jid)
+        if cached is not None:
+            return cached
+        with self._read() as conn:
+            row = conn.execute(
+                "SELECT status, code_expires_epoch FROM contacts WHERE jid = ?", (jid,)
+            ).fetchone()
+        status = ContactStatus(row[0]) if row else ContactStatus.UNKNOWN
+        if status == ContactStatus.PENDING:
+            # Expiry is time-sensitive, so pending contacts are never cached
+            if row[1] is not None and self._now() > row[1]:
                 logger.info("[SECURITY] Pairing code expired", jid=jid)
                 self._update_status(jid, ContactStatus.UNKNOWN)
                 return ContactStatus.UNKNOWN
-        return contact.status
+            return status
+        self._cache_status(jid, status)
+        return status
 
     def generate_pairing_code(self, jid: str, name: Optional[str] = None) -> str:
-        code = ''.join(secrets.choice('0123456789') for _ in range(self.code_length))
-        expires_at = datetime.now() + timedelta(minutes=self.code_expiry_minutes)
-
-        conn = sqlite3.connect(self.db_path)
-        conn.execute("""
-            INSERT INTO contacts (jid, status, pairing_code, code_expires_at, name, updated_at)
-            VALUES (?, 'pending', ?, ?, ?, CURRENT_TIMESTAMP)
-            ON CONFLICT(jid) DO UPDATE SET
-                status = 'pending',
-                pairing_code = excluded.pairing_code,
-                code_expires_at = excluded.code_expires_at,
-                name = COALESCE(excluded.name, contacts.name),
-                updated_at = CURRENT_TIMESTAMP
-        """, (jid, code, expires_at.isoformat(), name))
-        conn.commit()
-        conn.close()
-
-        logger.info("[SECURITY] Pairing code generated", jid=jid, expires_at=expires_at.isoformat())
+        code = f"{secrets.randbelow(self._code_modulus):0{self.code_length}d}"
+        expires_at = int(self._now()) + self.code_expiry_minutes * 60
+
+        with self._write() as conn:
+            conn.execute("""
+                INSERT INTO contacts (jid, status, pairing_code, code_expires_epoch, name, updated_at)
+                VALUES (?, 'pending', ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(jid) DO UPDATE SET
+                    status = 'pending',
+                    pairing_code = excluded.pairing_code,
+                    code_expires_epoch = excluded.code_expires_epoch,
+                    name = COALESCE(excluded.name, contacts.name),
+                    updated_at = CURRENT_TIMESTAMP
+            """, (jid, code, expires_at, name))
+        self._status_cache.pop(jid, None)
+
+        logger.info("[SECURITY] Pairing code generated", jid=jid,
+                    expires_at=datetime.fromtimestamp(expires_at).isoformat())
         return code
 
     def approve_contact(self, jid: str) -> bool:
-        conn = sqlite3.connect(self.db_path)
         now = datetime.now().isoformat()
-        result = conn.execute(
-            "UPDATE contacts SET status = 'approved', approved_at = ?, updated_at = ? WHERE jid = ?",
-            (now, now, jid)
-        )
-        if result.rowcount == 0:
-            conn.execute(
-                "INSERT INTO contacts (jid, status, approved_at, updated_at) VALUES (?, 'approved', ?, ?)",
-                (jid, now, now)
+        with self._write() as conn:
+            result = conn.execute(
+                "UPDATE contacts SET status = 'approved', approved_at = ?, updated_at = ? WHERE jid = ?",
+                (now, now, jid)
             )
-        conn.commit()
-        conn.close()
+            if result.rowcount == 0:
+                conn.execute(
+                    "INSERT INTO contacts (jid, status, approved_at, updated_at) VALUES (?, 'approved', ?, ?)",
+                    (jid, now, now)
+                )
+        self._status_cache.pop(jid, None)
         logger.info("[SECURITY] Contact approved", jid=jid)
         return True
 
     def approve_by_code(self, code: str) -> Optional[str]:
-        conn = sqlite3.connect(self.db_path)
-        row = conn.execute(
-            "SELECT jid, code_expires_at FROM contacts WHERE pairing_code = ? AND status = 'pending'",
-            (code,)
-        ).fetchone()
+        with self._write() as conn:
+            row = conn.execute(
+                "SELECT jid, code_expires_epoch FROM contacts WHERE pairing_code = ? AND status = 'pending'",
+                (code,)
+            ).fetchone()
 
-        if not row:
-            conn.close()
-            return None
+            if not row:
+                return None
 
-        jid = row[0]
-        expires_at = datetime.fromisoformat(row[1]) if row[1] else None
+            jid = row[0]
+            expires_at = row[1]
 
-        if expires_at and datetime.now() > expires_at:
-            conn.close()
-            logger.warning("[SECURITY] Attempted to use expired pairing code", code=code)
-            return None
+            if expires_at is not None and self._now() > expires_at:
+                logger.warning("[SECURITY] Attempted to use expired pairing code", code=code)
+                return None
 
-        now = datetime.now().isoformat()
-        conn.execute(
-            "UPDATE contacts SET status = 'approved', approved_at = ?, updated_at = ? WHERE jid = ?",
-            (now, now, jid)
-        )
-        conn.commit()
-        conn.close()
+            now = datetime.now().isoformat()
+            conn.execute(
+                "UPDATE contacts SET status = 'approved', approved_at = ?, updated_at = ? WHERE jid = ?",
+                (now, now, jid)
+            )
+        self._status_cache.pop(jid, None)
         logger.info("[SECURITY] Contact approved via pairing code", jid=jid)
         return jid
 
@@ -159,38 +300,49 @@ class PairingStore:
         return True
 
     def list_contacts(self, status: Optional[ContactStatus] = None) -> list[Contact]:
-        conn = sqlite3.connect(self.db_path)
-        if status:
-            rows = conn.execute(
-                "SELECT jid, status, pairing_code, code_expires_at, approved_at, name FROM contacts WHERE status = ? ORDER BY updated_at DESC",
-                (status.value,)
-            ).fetchall()
-        else:
-            rows = conn.execute(
-                "SELECT jid, status, pairing_code, code_expires_at, approved_at, name FROM contacts ORDER BY updated_at DESC"
-            ).fetchall()
-        conn.close()
+        with self._read() as conn:
+            if status:
+                rows = conn.execute(
+                    f"SELECT {_CONTACT_COLUMNS} FROM contacts WHERE status = ? ORDER BY updated_at DESC",
+                    (status.value,)
+                ).fetchall()
+            else:
+                rows = conn.execute(
+                    f"SELECT {_CONTACT_COLUMNS} FROM contacts ORDER BY updated_at DESC"
+                ).fetchall()
 
         return [Contact(
             jid=r[0], status=ContactStatus(r[1]), pairing_code=r[2],
-            code_expires_at=datetime.fromisoformat(r[3]) if r[3] else None,
-            approved_at=datetime.fromisoformat(r[4]) if r[4] else None,
+            code_expires_at=datetime.fromtimestamp(r[3]) if r[3] is not None else None,
+            approved_at=r[4],
             name=r[5]
         ) for r in rows]
 
+    def bulk_seed(self, entries: Iterable[tuple[str, ContactStatus]]):
+        """Upsert many (jid, status) pairs in a single transaction."""
+        rows = [(jid, status.value) for jid, status in entries]
+        with self._write() as conn:
+            conn.executemany("""
+                INSERT INTO contacts (jid, status, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(jid) DO UPDATE SET
+                    status = excluded.status,
+                    updated_at = CURRENT_TIMESTAMP
+            """, rows)
+        for jid, _ in rows:
+            self._status_cache.pop(jid, None)
+
     def _update_status(self, jid: str, status: ContactStatus):
-        conn = sqlite3.connect(self.db_path)
-        result = conn.execute(
-            "UPDATE contacts SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE jid = ?",
-            (status.value, jid)
-        )
-        if result.rowcount == 0:
-            conn.execute(
-                "INSERT INTO contacts (jid, status, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
-                (jid, status.value)
+        with self._write() as conn:
+            result = conn.execute(
+                "UPDATE contacts SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE jid = ?",
+                (status.value, jid)
             )
-        conn.commit()
-        conn.close()
+            if result.rowcount == 0:
+                conn.execute(
+                    "INSERT INTO contacts (jid, status, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
+                    (jid, status.value)
+                )
+        self._status_cache.pop(jid, None)
 
 
 if __name__ == "__main__":
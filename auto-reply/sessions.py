@@ -1,185 +1,484 @@
 # ABOUTME: Session manager for per-sender conversation history.
 # ABOUTME: Stores JSONL transcripts, handles idle reset and context compaction.
 
-import json
-from datetime import datetime, timedelta
+import asyncio
+import atexit
+import functools
+import hashlib
+import struct
+import sys
+import time
+import weakref
+from collections import OrderedDict, deque
+from datetime import datetime
 from pathlib import Path
-from dataclasses import dataclass, field, asdict
-from typing import Optional
+from dataclasses import dataclass, field, replace
+from typing import BinaryIO, Optional, Sequence
+import aiofiles
+import orjson
 import structlog
+from aiofiles.threadpool.binary import AsyncBufferedIOBase
 
 logger = structlog.get_logger("sessions")
 
+MAX_OPEN_TRANSCRIPTS = 64
+MAX_CACHED_HISTORIES = 64
 
-@dataclass
+# metadata.log records: op byte + payload length, then an orjson payload
+# (the full SessionMetadata for upserts, the bare key for deletes)
+_LOG_HEADER = struct.Struct("<BI")
+_LOG_UPSERT = 1
+_LOG_DELETE = 2
+METADATA_LOG_ROTATE_BYTES = 10 * 1024 * 1024
+
+
+def estimate_tokens(text: str) -> int:
+    # ASCII runs average ~4 chars per token, but emoji and non-Latin
+    # scripts tokenize to roughly one token per character or more
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+@functools.lru_cache(maxsize=4096)
+def _session_key(jid: str) -> str:
+    # Interned so lookups against keys loaded from disk match by identity
+    return sys.intern(f"whatsapp:{jid}")
+
+
+def now_us() -> int:
+    return time.time_ns() // 1000
+
+
+def _epoch_us(value) -> int:
+    # Files written before the switch to epoch microseconds hold ISO strings
+    if isinstance(value, str):
+        return int(datetime.fromisoformat(value).timestamp() * 1_000_000) if value else 0
+    return value
+
+
+@dataclass(slots=True)
 class SessionMessage:
     role: str  # "user", "assistant", "system"
     content: str
-    timestamp: str
+    timestamp: int = field(default_factory=now_us)  # epoch microseconds
     sender_jid: Optional[str] = None
     sender_name: Optional[str] = None
     type: Optional[str] = None  # "compaction", "reset", None for normal
+    # Estimated once here and persisted with the transcript line
+    token_count: int = field(default=0, compare=False)
+
+    def __post_init__(self):
+        self.timestamp = _epoch_us(self.timestamp)
+        if not self.token_count:
+            self.token_count = estimate_tokens(self.content)
+
 
+_ELISION = " … "
 
-@dataclass
+
+def _truncate_middle(msg: SessionMessage, budget: int) -> Optional[SessionMessage]:
+    # Start from ~4 chars per token and halve until the estimate fits,
+    # since non-ASCII text packs more tokens per character
+    half = budget * 2
+    while half > 0:
+        content = f"{msg.content[:half]}{_ELISION}{msg.content[-half:]}"
+        if estimate_tokens(content) <= budget:
+            return replace(msg, content=content, token_count=0)
+        half //= 2
+    return None
+
+
+def _content_hash(msg: SessionMessage) -> int:
+    # Stable across restarts, unlike hash(), since it is persisted in metadata
+    digest = hashlib.blake2b(f"{msg.role}\0{msg.content}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _api_message(msg: SessionMessage) -> Optional[dict]:
+    if msg.role in ("user", "assistant"):
+        return {"role": msg.role, "content": msg.content}
+    if msg.role == "system" and msg.type == "compaction":
+        return {"role": "user", "content": f"[Previous conversation summary: {msg.content}]"}
+    return None
+
+
+@dataclass(slots=True)
 class SessionMetadata:
     session_key: str
-    last_activity: str
+    last_activity: int  # epoch microseconds
     message_count: int = 0
     estimated_tokens: int = 0
-    created_at: str = ""
+    created_at: int = 0
     sender_name: str = ""
+    last_content_hash: int = 0
+
+    def __post_init__(self):
+        self.last_activity = _epoch_us(self.last_activity)
+        self.created_at = _epoch_us(self.created_at)
+
+
+@dataclass(slots=True)
+class _CachedHistory:
+    messages: deque[SessionMessage]
+    # API-format view, built on first request and extended in place on append
+    api: Optional[list[dict]] = None
+
+
+def _flush_if_alive(flush_ref: weakref.WeakMethod):
+    flush = flush_ref()
+    if flush is not None:
+        flush()
 
 
 class SessionManager:
     def __init__(self, storage_dir: str = "sessions",
                  idle_reset_minutes: int = 60,
                  max_history_tokens: int = 50000,
-                 compaction_target_tokens: int = 10000):
+                 compaction_target_tokens: int = 10000,
+                 flush_interval: float = 5.0,
+                 prune_before_compact: bool = True,
+                 dedup_consecutive: bool = True):
         self.storage_dir = Path(storage_dir)
         self.idle_reset_minutes = idle_reset_minutes
         self.max_history_tokens = max_history_tokens
         self.compaction_target_tokens = compaction_target_tokens
+        self.flush_interval = flush_interval
+        self.prune_before_compact = prune_before_compact
+        self.dedup_consecutive = dedup_consecutive
 
         self.storage_dir.mkdir(parents=True, exist_ok=True)
         self._metadata: dict[str, SessionMetadata] = {}
+        # Transcripts are appended immediately, so metadata only needs to be
+        # logged periodically and on shutdown, and only for sessions that changed
+        self._dirty_keys: set[str] = set()
+        self._log: Optional[BinaryIO] = None
+        # Hash of the last record persisted per session, to skip no-op rewrites
+        self._persisted: dict[str, int] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._handles: OrderedDict[str, AsyncBufferedIOBase] = OrderedDict()
+        self._history_cache: OrderedDict[str, _CachedHistory] = OrderedDict()
         self._load_metadata()
+        # Held weakly so an unclosed manager can still be collected; the exit
+        # hook is dropped along with it
+        self._exit_flush = functools.partial(_flush_if_alive, weakref.WeakMethod(self.flush))
+        atexit.register(self._exit_flush)
+        weakref.finalize(self, atexit.unregister, self._exit_flush)
 
     def _metadata_path(self) -> Path:
         return self.storage_dir / "metadata.json"
 
+    def _metadata_log_path(self) -> Path:
+        return self.storage_dir / "metadata.log"
+
     def _session_path(self, session_key: str) -> Path:
         safe_name = session_key.replace(":", "_").replace("/", "_")
         return self.storage_dir / f"{safe_name}.jsonl"
 
+    async def _get_handle(self, session_key: str) -> AsyncBufferedIOBase:
+        handle = self._handles.get(session_key)
+        if handle is not None:
+            self._handles.move_to_end(session_key)
+            return handle
+        # Buffered so a short write can't truncate a line; add_messages flushes
+        # after each append so the message is on disk before the next read
+        handle = await aiofiles.open(self._session_path(session_key), "ab")
+        self._handles[session_key] = handle
+        if len(self._handles) > MAX_OPEN_TRANSCRIPTS:
+            _, evicted = self._handles.popitem(last=False)
+            await evicted.close()
+        return handle
+
+    async def _close_handle(self, session_key: str):
+        handle = self._handles.pop(session_key, None)
+        if handle is not None:
+            await handle.close()
+
+    async def _rewrite_transcript(self, session_key: str, messages: list[SessionMessage]):
+        # Write aside and swap in, so a crash mid-compaction keeps the old transcript
+        path = self._session_path(session_key)
+        tmp = path.with_suffix(".tmp")
+        async with aiofiles.open(tmp, "wb") as f:
+            await f.write(b"".join(orjson.dumps(m) + b"\n" for m in messages))
+        tmp.replace(path)
+        self._cache_history(session_key, deque(messages))
+
+    def _cache_history(self, session_key: str, history: deque[SessionMessage]) -> _CachedHistory:
+        entry = self._history_cache[session_key] = _CachedHistory(history)
+        self._history_cache.move_to_end(session_key)
+        if len(self._history_cache) > MAX_CACHED_HISTORIES:
+            self._history_cache.popitem(last=False)
+        return entry
+
     def _load_metadata(self):
-        path = self._metadata_path()
-        if path.exists():
-            with open(path) as f:
-                data = json.load(f)
-                self._metadata = {
-                    k: SessionMetadata(**v) for k, v in data.items()
-                }
+        try:
+            data = orjson.loads(self._metadata_path().read_bytes())
+            self._metadata = {
+                sys.intern(k): SessionMetadata(**v) for k, v in data.items()
+            }
+        except FileNotFoundError:
+            pass
+        try:
+            log = self._metadata_log_path().read_bytes()
+        except FileNotFoundError:
+            return
+        self._replay_log(log)
+        # Fold the replayed log into a fresh snapshot so it starts empty
+        self._save_metadata()
+
+    def _replay_log(self, log: bytes):
+        offset = 0
+        while offset + _LOG_HEADER.size <= len(log):
+            op, length = _LOG_HEADER.unpack_from(log, offset)
+            start = offset + _LOG_HEADER.size
+            if start + length > len(log):
+                break  # torn final record from a crash mid-write
+            payload = orjson.loads(log[start:start + length])
+            if op == _LOG_UPSERT:
+                self._metadata[sys.intern(payload["session_key"])] = SessionMetadata(**payload)
+            elif op == _LOG_DELETE:
+                self._metadata.pop(payload, None)
+            offset = start + length
 
     def _save_metadata(self):
-        with open(self._metadata_path(), "w") as f:
-            json.dump({k: asdict(v) for k, v in self._metadata.items()}, f, indent=2)
+        # orjson serializes the dataclasses natively, no asdict() copy needed
+        tmp = self._metadata_path().with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            f.write(orjson.dumps(self._metadata, option=orjson.OPT_INDENT_2))
+        tmp.replace(self._metadata_path())
+        # The snapshot now covers everything the log recorded
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        self._metadata_log_path().unlink(missing_ok=True)
+
+    def _append_log(self, keys: set[str]):
+        records = []
+        for key in keys:
+            meta = self._metadata.get(key)
+            if meta is None:
+                self._persisted.pop(key, None)
+                op, payload = _LOG_DELETE, orjson.dumps(key)
+            else:
+                payload = orjson.dumps(meta)
+                digest = hash(payload)
+                if self._persisted.get(key) == digest:
+                    continue
+                self._persisted[key] = digest
+                op = _LOG_UPSERT
+            records.append(_LOG_HEADER.pack(op, len(payload)))
+            records.append(payload)
+        if not records:
+            return
+        if self._log is None:
+            self._log = open(self._metadata_log_path(), "ab")
+        self._log.write(b"".join(records))
+        self._log.flush()
+        if self._log.tell() > METADATA_LOG_ROTATE_BYTES:
+            self._save_metadata()
 
-    def _estimate_tokens(self, text: str) -> int:
-        return len(text) // 4
+    def _mark_dirty(self, session_key: str):
+        self._dirty_keys.add(session_key)
+        if self._flush_task is None or self._flush_task.done():
+            try:
+                self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+            except RuntimeError:
+                # No event loop: callers outside asyncio rely on flush()/atexit
+                pass
+
+    async def _flush_loop(self):
+        while self._dirty_keys:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        if self._dirty_keys:
+            keys, self._dirty_keys = self._dirty_keys, set()
+            self._append_log(keys)
+
+    async def aclose(self):
+        """Stop the background flusher, write pending metadata and close transcripts."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        self.flush()
+        atexit.unregister(self._exit_flush)
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        for handle in self._handles.values():
+            await handle.close()
+        self._handles.clear()
 
     def session_key_for_jid(self, jid: str) -> str:
-        return f"whatsapp:{jid}"
+        return _session_key(jid)
 
-    def get_or_create_session(self, jid: str, sender_name: str = "") -> str:
+    async def get_or_create_session(self, jid: str, sender_name: str = "") -> str:
         key = self.session_key_for_jid(jid)
 
         if key in self._metadata:
             meta = self._metadata[key]
-            last = datetime.fromisoformat(meta.last_activity)
-            if datetime.now() - last > timedelta(minutes=self.idle_reset_minutes):
+            idle_us = now_us() - meta.last_activity
+            if idle_us > self.idle_reset_minutes * 60_000_000:
                 logger.info("session_idle_reset", session_key=key,
-                    idle_minutes=(datetime.now() - last).total_seconds() / 60)
-                self.reset_session(key, reason="idle timeout")
+                    idle_minutes=idle_us / 60_000_000)
+                await self.reset_session(key, reason="idle timeout")
                 return self._create_session(key, sender_name)
             return key
         else:
             return self._create_session(key, sender_name)
 
     def _create_session(self, key: str, sender_name: str = "") -> str:
-        now = datetime.now().isoformat()
+        now = now_us()
         self._metadata[key] = SessionMetadata(
             session_key=key,
             last_activity=now,
             created_at=now,
             sender_name=sender_name
         )
-        self._save_metadata()
+        self._mark_dirty(key)
         logger.info("session_created", session_key=key, sender_name=sender_name)
         return key
 
-    def add_message(self, session_key: str, message: SessionMessage):
-        path = self._session_path(session_key)
-        with open(path, "a") as f:
-            f.write(json.dumps(asdict(message)) + "\n")
+    async def add_message(self, session_key: str, message: SessionMessage):
+        await self.add_messages(session_key, (message,))
+
+    async def add_messages(self, session_key: str, messages: Sequence[SessionMessage]) -> bool:
+        """Append messages with one write; returns whether the session now needs compaction."""
+        meta = self._metadata.get(session_key)
+        if meta is not None and self.dedup_consecutive:
+            # Redelivered webhooks repeat the previous message verbatim
+            last, fresh = meta.last_content_hash, []
+            for m in messages:
+                digest = _content_hash(m)
+                if digest != last:
+                    fresh.append(m)
+                    last = digest
+            meta.last_content_hash = last
+            messages = fresh
+        if not messages:
+            return self.needs_compaction(session_key)
+        handle = await self._get_handle(session_key)
+        await handle.write(b"".join(orjson.dumps(m) + b"\n" for m in messages))
+        await handle.flush()
+        cached = self._history_cache.get(session_key)
+        if cached is not None:
+            cached.messages.extend(messages)
+            if cached.api is not None:
+                cached.api.extend(m for m in map(_api_message, messages) if m is not None)
+
+        if meta is not None:
+            meta.message_count += len(messages)
+            meta.estimated_tokens += sum(m.token_count for m in messages)
+            meta.last_activity = messages[-1].timestamp
+            sender_name = next((m.sender_name for m in reversed(messages) if m.sender_name), None)
+            if sender_name:
+                meta.sender_name = sender_name
+            self._mark_dirty(session_key)
+        return self.needs_compaction(session_key)
+
+    async def _load_cached(self, session_key: str) -> Optional[_CachedHistory]:
+        cached = self._history_cache.get(session_key)
+        if cached is not None:
+            self._history_cache.move_to_end(session_key)
+            return cached
+
+        try:
+            async with aiofiles.open(self._session_path(session_key), "rb") as f:
+                # One read instead of an awaited thread hop per line
+                raw = await f.read()
+        except FileNotFoundError:
+            return None
+        messages = deque(
+            SessionMessage(**orjson.loads(line))
+            for line in raw.splitlines() if line.strip()
+        )
+        return self._cache_history(session_key, messages)
 
-        if session_key in self._metadata:
-            meta = self._metadata[session_key]
-            meta.message_count += 1
-            meta.estimated_tokens += self._estimate_tokens(message.content)
-            meta.last_activity = message.timestamp
-            if message.sender_name:
-                meta.sender_name = message.sender_name
-            self._save_metadata()
+    async def get_history(self, session_key: str) -> list[SessionMessage]:
+        cached = await self._load_cached(session_key)
+        return list(cached.messages) if cached is not None else []
 
-    def get_history(self, session_key: str) -> list[SessionMessage]:
-        path = self._session_path(session_key)
-        if not path.exists():
+    async def get_history_as_api_messages(self, session_key: str) -> list[dict]:
+        cached = await self._load_cached(session_key)
+        if cached is None:
             return []
-
-        messages = []
-        with open(path) as f:
-            for line in f:
-                line = line.strip()
-                if line:
-                    data = json.loads(line)
-                    messages.append(SessionMessage(**data))
-        return messages
-
-    def get_history_as_api_messages(self, session_key: str) -> list[dict]:
-        history = self.get_history(session_key)
-        messages = []
-        for msg in history:
-            if msg.role in ("user", "assistant"):
-                messages.append({"role": msg.role, "content": msg.content})
-            elif msg.role == "system" and msg.type == "compaction":
-                messages.append({"role": "user", "content": f"[Previous conversation summary: {msg.content}]"})
-        return messages
+        if cached.api is None:
+            cached.api = [m for m in map(_api_message, cached.messages) if m is not None]
+        return list(cached.api)
 
     def needs_compaction(self, session_key: str) -> bool:
         if session_key not in self._metadata:
             return False
         return self._metadata[session_key].estimated_tokens > self.max_history_tokens
 
-    def compact_session(self, session_key: str, summary: str):
-        path = self._session_path(session_key)
-        now = datetime.now().isoformat()
-
+    def _prune_for_compaction(self, history: list[SessionMessage]) -> list[SessionMessage]:
+        # Reset markers and earlier summaries are superseded by the new summary;
+        # back-to-back repeats (e.g. redelivered webhooks) collapse to one copy.
+        # Only adjacent repeats go: a short "ok" recurring across turns is real
+        # conversation, and dropping it would leave questions without answers
+        pruned = []
+        for msg in history:
+            if msg.role == "system" and msg.type in ("reset", "compaction"):
+                continue
+            if pruned and pruned[-1].role == msg.role and pruned[-1].content == msg.content:
+                continue
+            pruned.append(msg)
+        return pruned
+
+    async def compact_session(self, session_key: str, summary: str):
+        history = await self.get_history(session_key)
+        if self.prune_before_compact:
+            history = self._prune_for_compaction(history)
+        await self._close_handle(session_key)
         compaction_msg = SessionMessage(
             role="system",
             content=summary,
-            timestamp=now,
             type="compaction"
         )
 
-        with open(path, "w") as f:
-            f.write(json.dumps(asdict(compaction_msg)) + "\n")
+        # Keep the most recent messages that fit alongside the summary,
+        # middle-truncating the oldest one that only partly fits
+        budget = self.compaction_target_tokens - compaction_msg.token_count
+        kept = deque()
+        for msg in reversed(history):
+            if msg.token_count <= budget:
+                kept.appendleft(msg)
+                budget -= msg.token_count
+                continue
+            if budget > 0:
+                truncated = _truncate_middle(msg, budget)
+                if truncated is not None:
+                    kept.appendleft(truncated)
+            break
+        kept.appendleft(compaction_msg)
+        await self._rewrite_transcript(session_key, list(kept))
 
         if session_key in self._metadata:
             meta = self._metadata[session_key]
-            meta.message_count = 1
-            meta.estimated_tokens = self._estimate_tokens(summary)
-            self._save_metadata()
+            meta.message_count = len(kept)
+            meta.estimated_tokens = sum(m.token_count for m in kept)
+            self._mark_dirty(session_key)
 
         logger.info("session_compacted", session_key=session_key,
-            summary_tokens=self._estimate_tokens(summary))
+            summary_tokens=compaction_msg.token_count, kept_messages=len(kept) - 1)
 
-    def reset_session(self, session_key: str, reason: str = "manual"):
-        path = self._session_path(session_key)
-        if path.exists():
-            now = datetime.now().isoformat()
+    async def reset_session(self, session_key: str, reason: str = "manual"):
+        await self._close_handle(session_key)
+        if self._session_path(session_key).exists():
             reset_msg = SessionMessage(
                 role="system",
                 content=f"Session reset: {reason}",
-                timestamp=now,
                 type="reset"
             )
-            with open(path, "w") as f:
-                f.write(json.dumps(asdict(reset_msg)) + "\n")
+            await self._rewrite_transcript(session_key, [reset_msg])
 
         if session_key in self._metadata:
             del self._metadata[session_key]
-            self._save_metadata()
+            self._mark_dirty(session_key)
 
         logger.info("session_reset", session_key=session_key, reason=reason)
 
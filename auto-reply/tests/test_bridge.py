@@ -52,7 +52,8 @@ async def mock_server(mock_bridge_app, aiohttp_server):
 @pytest_asyncio.fixture
 async def client(mock_server):
     base_url = f"http://localhost:{mock_server.port}/api"
-    return BridgeClient(base_url=base_url, timeout=5)
+    async with BridgeClient(base_url=base_url, timeout=5) as bridge:
+        yield bridge
 
 
 class TestSendMessage:
@@ -75,6 +76,21 @@ class TestSendMessage:
         success, msg = await client.send_message("", "No recipient")
         assert success is False
 
+    @pytest.mark.asyncio
+    async def test_reuses_session_across_calls(self, client, mock_server):
+        await client.send_message("user@s.whatsapp.net", "First")
+        session = client._session
+        await client.send_message("user@s.whatsapp.net", "Second")
+        assert client._session is session
+
+    @pytest.mark.asyncio
+    async def test_aclose_closes_session(self, client, mock_server):
+        await client.send_message("user@s.whatsapp.net", "Hello")
+        session = client._session
+        await client.aclose()
+        assert session.closed
+        assert client._session is None
+
 
 class TestSendChunked:
     @pytest.mark.asyncio
@@ -84,6 +100,53 @@ class TestSendChunked:
         assert len(results) == 3
         assert all(success for success, _ in results)
 
+    @pytest.mark.asyncio
+    async def test_chunks_delivered_in_order(self, client, mock_server):
+        chunks = [f"Part {i}" for i in range(6)]
+        await client.send_chunked("user@s.whatsapp.net", chunks, delay=0.01)
+        sent = [m["message"] for m in mock_server.app["sent_messages"]]
+        assert sent == chunks
+
+    @pytest.mark.asyncio
+    async def test_stops_after_first_failure(self, client, mock_server):
+        results = await client.send_chunked("", ["Part 1", "Part 2", "Part 3"], delay=0.05)
+        assert len(results) == 1
+        assert results[0][0] is False
+
+    @pytest.mark.asyncio
+    async def test_slow_failed_chunk_stops_paced_send(self, client, monkeypatch):
+        sent = []
+
+        async def fake_send(recipient, chunk):
+            if chunk == "c0":
+                await asyncio.sleep(0.1)
+                sent.append(chunk)
+                return False, "fail"
+            sent.append(chunk)
+            return True, "ok"
+        monkeypatch.setattr(client, "send_message", fake_send)
+        results = await client.send_chunked("user@s.whatsapp.net", ["c0", "c1", "c2"], delay=0.01)
+        await asyncio.sleep(0.05)
+        assert results == [(False, "fail")]
+        assert sent == ["c0"]
+
+    @pytest.mark.asyncio
+    async def test_default_sends_in_order_without_sleeping(self, client, mock_server, monkeypatch):
+        async def no_sleep(delay):
+            raise AssertionError("send_chunked slept between chunks")
+        monkeypatch.setattr("bridge.asyncio.sleep", no_sleep)
+        chunks = [f"Part {i}" for i in range(6)]
+        results = await client.send_chunked("user@s.whatsapp.net", chunks)
+        assert all(success for success, _ in results)
+        sent = [m["message"] for m in mock_server.app["sent_messages"]]
+        assert sent == chunks
+
+    @pytest.mark.asyncio
+    async def test_unpaced_send_stops_after_first_failure(self, client, mock_server):
+        results = await client.send_chunked("", ["Part 1", "Part 2"])
+        assert len(results) == 1
+        assert results[0][0] is False
+
     @pytest.mark.asyncio
     async def test_empty_chunks_returns_empty(self, client, mock_server):
         results = await client.send_chunked("user@s.whatsapp.net", [], delay=0)
@@ -93,8 +156,8 @@ class TestSendChunked:
 class TestConnectionFailure:
     @pytest.mark.asyncio
     async def test_connection_refused_returns_error(self):
-        client = BridgeClient(base_url="http://localhost:1/api", timeout=1)
-        success, msg = await client.send_message("user@s.whatsapp.net", "Hello")
+        async with BridgeClient(base_url="http://localhost:1/api", timeout=1) as client:
+            success, msg = await client.send_message("user@s.whatsapp.net", "Hello")
         assert success is False
         assert "Cannot connect" in msg or "Unexpected error" in msg
 
@@ -107,6 +170,6 @@ class TestHealthCheck:
 
     @pytest.mark.asyncio
     async def test_health_check_with_dead_server(self):
-        client = BridgeClient(base_url="http://localhost:1/api", timeout=1)
-        result = await client.health_check()
+        async with BridgeClient(base_url="http://localhost:1/api", timeout=1) as client:
+            result = await client.health_check()
         assert result is False
@@ -53,6 +53,13 @@ class TestParagraphBreaking:
             assert len(result) >= 2
             assert result[0].endswith("More text.")
 
+    def test_slightly_oversized_text_splits_once_at_paragraph(self):
+        chunker = ResponseChunker(max_length=100, min_length=10)
+        para1 = "A" * 60
+        para2 = "B" * 50
+        result = chunker.chunk(para1 + "\n\n" + para2)
+        assert result == [para1, para2]
+
 
 class TestSentenceBreaking:
     def test_splits_at_sentence_boundary(self):
@@ -63,6 +70,12 @@ class TestSentenceBreaking:
         # First chunk should end at a sentence boundary
         assert result[0].endswith(".")
 
+    def test_uses_last_sentence_boundary_in_window(self):
+        chunker = ResponseChunker(max_length=60, min_length=10)
+        text = "One. Two! Three? Four sentence is here. And this part runs past the limit."
+        result = chunker.chunk(text)
+        assert result[0] == "One. Two! Three? Four sentence is here."
+
 
 class TestHardCut:
     def test_hard_cut_when_no_break_point(self):
@@ -1,11 +1,19 @@
 # ABOUTME: Tests for the Claude Code CLI runner.
 # ABOUTME: Covers session mapping, command construction, and error handling.
 
+import asyncio
+import contextlib
 import json
+import sys
+import aiofiles
 import pytest
 from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock
 
-from claude_runner import ClaudeRunner, DEFAULT_ALLOWED_TOOLS, DEFAULT_DISALLOWED_TOOLS
+from claude_runner import (
+    AIMDLimiter, ClaudeRunner, DEFAULT_ALLOWED_TOOLS, DEFAULT_DISALLOWED_TOOLS, PERPLEXITY_TOOLS,
+    STDERR_CAPTURE_BYTES, system_append_for,
+)
 
 
 @pytest.fixture
@@ -21,57 +29,144 @@ def runner(tmp_path):
     )
 
 
+@pytest.fixture(scope="module")
+def shared_runner(tmp_path_factory):
+    """One workspace and runner for the read-mostly session mapping tests."""
+    workspace = tmp_path_factory.mktemp("shared") / "workspace"
+    workspace.mkdir()
+    (workspace / "CLAUDE.md").write_text("Test assistant persona.")
+    return ClaudeRunner(
+        workspace_dir=str(workspace),
+        model="test-model",
+        max_turns=3,
+        timeout=30,
+    )
+
+
 class TestSessionMapping:
-    def test_new_sender_has_no_session(self, runner):
-        assert runner.get_session_id("unknown@s.whatsapp.net") is None
+    @pytest.fixture(autouse=True)
+    def _reset_shared_runner(self, shared_runner):
+        yield
+        shared_runner._session_map.clear()
+        shared_runner._session_map_path.unlink(missing_ok=True)
 
-    def test_session_map_persists_to_disk(self, runner):
-        runner._session_map["user@s.whatsapp.net"] = "session-abc-123"
-        runner._save_session_map()
+    def test_new_sender_has_no_session(self, shared_runner):
+        assert shared_runner.get_session_id("unknown@s.whatsapp.net") is None
+
+    @pytest.mark.asyncio
+    async def test_session_map_persists_to_disk(self, shared_runner):
+        shared_runner._session_map["user@s.whatsapp.net"] = "session-abc-123"
+        await shared_runner._save_session_map()
 
         # Create new runner pointing at same workspace
         runner2 = ClaudeRunner(
-            workspace_dir=runner.workspace_dir,
+            workspace_dir=shared_runner.workspace_dir,
             model="test-model",
         )
         assert runner2.get_session_id("user@s.whatsapp.net") == "session-abc-123"
 
-    def test_clear_session_removes_mapping(self, runner):
-        runner._session_map["user@s.whatsapp.net"] = "session-abc-123"
-        runner._save_session_map()
+    @pytest.mark.asyncio
+    async def test_clear_session_removes_mapping(self, shared_runner):
+        shared_runner._session_map["user@s.whatsapp.net"] = "session-abc-123"
+        await shared_runner._save_session_map()
+
+        await shared_runner.clear_session("user@s.whatsapp.net")
+        assert shared_runner.get_session_id("user@s.whatsapp.net") is None
+        await shared_runner._flush_now()
+        assert json.loads(shared_runner._session_map_path.read_text()) == {}
+        await shared_runner.aclose()
+
+    @pytest.mark.asyncio
+    async def test_clear_nonexistent_session_is_noop(self, shared_runner):
+        await shared_runner.clear_session("nobody@s.whatsapp.net")
 
-        runner.clear_session("user@s.whatsapp.net")
-        assert runner.get_session_id("user@s.whatsapp.net") is None
+    @pytest.mark.asyncio
+    async def test_multiple_senders_have_separate_sessions(self, shared_runner):
+        shared_runner._session_map["a@s.whatsapp.net"] = "session-a"
+        shared_runner._session_map["b@s.whatsapp.net"] = "session-b"
+        await shared_runner._save_session_map()
+
+        assert shared_runner.get_session_id("a@s.whatsapp.net") == "session-a"
+        assert shared_runner.get_session_id("b@s.whatsapp.net") == "session-b"
 
-    def test_clear_nonexistent_session_is_noop(self, runner):
-        runner.clear_session("nobody@s.whatsapp.net")
+    @pytest.mark.asyncio
+    async def test_save_is_atomic_and_compact(self, shared_runner):
+        shared_runner._session_map["user@s.whatsapp.net"] = "session-abc-123"
+        await shared_runner._save_session_map()
 
-    def test_multiple_senders_have_separate_sessions(self, runner):
+        path = shared_runner._session_map_path
+        assert path.read_text() == '{"user@s.whatsapp.net":"session-abc-123"}'
+        assert not path.with_suffix(".tmp").exists()
+
+    def test_empty_session_map_file_is_ignored(self, tmp_path):
+        workspace = tmp_path / "ws"
+        workspace.mkdir()
+        (workspace / ".session_map.json").write_text("")
+        runner = ClaudeRunner(workspace_dir=str(workspace))
+        assert runner._session_map == {}
+
+    @pytest.mark.asyncio
+    async def test_scheduled_saves_are_coalesced(self, runner):
+        runner.save_debounce = 0.01
         runner._session_map["a@s.whatsapp.net"] = "session-a"
+        runner._schedule_save()
         runner._session_map["b@s.whatsapp.net"] = "session-b"
-        runner._save_session_map()
+        runner._schedule_save()
+        assert not runner._session_map_path.exists()
 
-        assert runner.get_session_id("a@s.whatsapp.net") == "session-a"
-        assert runner.get_session_id("b@s.whatsapp.net") == "session-b"
+        await asyncio.sleep(0.05)
+        assert json.loads(runner._session_map_path.read_text()) == {
+            "a@s.whatsapp.net": "session-a",
+            "b@s.whatsapp.net": "session-b",
+        }
+        await runner.aclose()
 
+    @pytest.mark.asyncio
+    async def test_flush_now_skips_write_when_clean(self, runner):
+        await runner._flush_now()
+        assert not runner._session_map_path.exists()
 
-class TestDefaultTools:
-    def test_allowed_tools_include_read_only_operations(self):
-        assert "Read" in DEFAULT_ALLOWED_TOOLS
-        assert "Grep" in DEFAULT_ALLOWED_TOOLS
-        assert "WebSearch" in DEFAULT_ALLOWED_TOOLS
+    @pytest.mark.asyncio
+    async def test_aclose_flushes_pending_save(self, runner):
+        runner.save_debounce = 60
+        runner._session_map["user@s.whatsapp.net"] = "session-abc-123"
+        runner._schedule_save()
+        await runner.aclose()
+        assert json.loads(runner._session_map_path.read_text()) == {
+            "user@s.whatsapp.net": "session-abc-123",
+        }
 
-    def test_disallowed_tools_block_write_operations(self):
-        assert "Bash" in DEFAULT_DISALLOWED_TOOLS
-        assert "Edit" in DEFAULT_DISALLOWED_TOOLS
-        assert "Write" in DEFAULT_DISALLOWED_TOOLS
+    @pytest.mark.asyncio
+    async def test_aclose_during_in_flight_save_still_writes(self, runner, monkeypatch):
+        real_open = aiofiles.open
 
-    def test_disallowed_tools_block_slack(self):
-        assert "mcp__slack__*" in DEFAULT_DISALLOWED_TOOLS
+        @contextlib.asynccontextmanager
+        async def slow_open(path, mode):
+            async with real_open(path, mode) as f:
+                await asyncio.sleep(0.05)
+                yield f
+        monkeypatch.setattr("claude_runner.aiofiles.open", slow_open)
+        runner.save_debounce = 0
+        runner._session_map["user@s.whatsapp.net"] = "session-abc-123"
+        runner._schedule_save()
+        await asyncio.sleep(0.01)  # the loop is now inside the write
+        await runner.aclose()
+        assert json.loads(runner._session_map_path.read_text()) == {
+            "user@s.whatsapp.net": "session-abc-123",
+        }
+
+
+class TestDefaultTools:
+    @pytest.mark.parametrize("expected, tools", [
+        ({"Read", "Grep", "WebSearch"}, DEFAULT_ALLOWED_TOOLS),
+        ({"Bash", "Edit", "Write", "mcp__slack__*"}, DEFAULT_DISALLOWED_TOOLS),
+    ], ids=["allowed-read-only", "disallowed-writes-and-slack"])
+    def test_default_tool_sets(self, expected, tools):
+        assert expected <= set(tools)
 
     def test_perplexity_tools_allowed(self):
-        perplexity_tools = [t for t in DEFAULT_ALLOWED_TOOLS if "perplexity" in t]
-        assert len(perplexity_tools) >= 3
+        assert len(PERPLEXITY_TOOLS) >= 3
+        assert PERPLEXITY_TOOLS <= set(DEFAULT_ALLOWED_TOOLS)
 
 
 class TestRunnerConfig:
@@ -92,13 +187,159 @@ class TestRunnerConfig:
         assert runner.allowed_tools == ["Read", "WebSearch"]
         assert runner.disallowed_tools == ["Bash"]
 
+    def test_base_command_precomputed(self, runner):
+        assert runner._base_cmd == [
+            "claude", "-p", "--output-format", "json",
+            "--model", "test-model", "--max-turns", "3",
+        ]
+        assert runner._allowed_tools_arg == ",".join(DEFAULT_ALLOWED_TOOLS)
+        assert runner._disallowed_tools_arg == ",".join(DEFAULT_DISALLOWED_TOOLS)
+        assert runner._tool_args == [
+            "--allowedTools", runner._allowed_tools_arg,
+            "--disallowedTools", runner._disallowed_tools_arg,
+        ]
+
+    def test_system_append_cached_per_sender(self):
+        assert system_append_for("Alice") is system_append_for("Alice")
+        assert system_append_for("Alice").startswith("You are chatting with Alice on WhatsApp.")
+        assert "someone" in system_append_for("")
+
+
+class TestAIMDLimiter:
+    def test_failure_halves_limit(self):
+        limiter = AIMDLimiter(maximum=8, target_latency=1.0)
+        limiter.record(0.1, ok=False)
+        assert limiter.limit == 4
+        limiter.record(0.1, ok=False)
+        assert limiter.limit == 2
+
+    def test_slow_window_halves_and_fast_calls_recover(self):
+        limiter = AIMDLimiter(maximum=4, target_latency=1.0, window=1)
+        limiter.record(5.0)
+        assert limiter.limit == 2
+        limiter.record(0.1)
+        limiter.record(0.1)
+        limiter.record(0.1)
+        assert limiter.limit == 4
+
+    def test_limit_never_drops_below_minimum(self):
+        limiter = AIMDLimiter(maximum=2, minimum=1)
+        for _ in range(5):
+            limiter.record(0.1, ok=False)
+        assert limiter.limit == 1
+
+    @pytest.mark.asyncio
+    async def test_caps_concurrent_holders(self):
+        limiter = AIMDLimiter(maximum=2)
+        active = 0
+        peak = 0
+
+        async def worker():
+            nonlocal active, peak
+            async with limiter:
+                active += 1
+                peak = max(peak, active)
+                await asyncio.sleep(0.01)
+                active -= 1
+
+        await asyncio.gather(*(worker() for _ in range(6)))
+        assert peak == 2
+
+
+class TestThrottle:
+    @pytest.mark.asyncio
+    async def test_disabled_by_default(self, runner):
+        for _ in range(100):
+            await runner.wait_if_throttled()
+        assert len(runner._request_times) == 0
+
+    @pytest.mark.asyncio
+    async def test_waits_when_window_is_full(self, runner, monkeypatch):
+        runner.max_requests_per_minute = 2
+        await runner.wait_if_throttled()
+        await runner.wait_if_throttled()
+
+        slept = []
+
+        async def fake_sleep(seconds):
+            slept.append(seconds)
+            runner._request_times.popleft()
+
+        monkeypatch.setattr("claude_runner.asyncio.sleep", fake_sleep)
+        await runner.wait_if_throttled()
+        assert len(slept) == 1
+        assert 0 < slept[0] <= 60
+
+
+class TestCommunicate:
+    @pytest.mark.asyncio
+    async def test_echoes_stdout_and_caps_stderr(self):
+        script = (
+            "import sys; data = sys.stdin.read(); "
+            "sys.stderr.write('e' * 100000); sys.stdout.write(data.upper())"
+        )
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-c", script,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await ClaudeRunner._communicate(proc, b"hello")
+        assert stdout == b"HELLO"
+        assert len(stderr) == STDERR_CAPTURE_BYTES
+        assert proc.returncode == 0
+
+
+FAKE_CLI = """
+import json, sys
+if "--resume" in sys.argv:
+    sys.stderr.write("Error: no session found")
+    sys.exit(1)
+sys.stdout.write(json.dumps({"result": "Reply: " + sys.stdin.read(), "session_id": "fresh"}))
+"""
+
 
 class TestGenerateReplyErrorCases:
     @pytest.mark.asyncio
-    async def test_timeout_returns_friendly_message(self, runner):
-        # Set impossibly short timeout
-        runner.timeout = 0.001
+    async def test_stale_session_retried_once_without_resume(self, runner, tmp_path):
+        script = tmp_path / "fake_claude.py"
+        script.write_text(FAKE_CLI)
+        runner._base_cmd = [sys.executable, str(script)]
+        runner._session_map["user@s.whatsapp.net"] = "stale"
+
+        reply = await runner.generate_reply("user@s.whatsapp.net", "Hello")
+
+        assert reply == "Reply: Hello"
+        assert runner.get_session_id("user@s.whatsapp.net") == "fresh"
+        await runner.aclose()
+
+    @pytest.mark.asyncio
+    async def test_failed_exit_does_not_shrink_concurrency(self, runner, tmp_path):
+        script = tmp_path / "fake_claude.py"
+        script.write_text(FAKE_CLI)
+        runner._base_cmd = [sys.executable, str(script)]
+        runner._session_map["user@s.whatsapp.net"] = "stale"
+        limit = runner._limiter.limit
+
+        await runner.generate_reply("user@s.whatsapp.net", "Hello")
+
+        assert runner._limiter.limit == limit
+        await runner.aclose()
+
+    @pytest.mark.asyncio
+    async def test_timeout_returns_friendly_message(self, runner, monkeypatch):
+        proc = MagicMock(returncode=None)
+        proc.wait = AsyncMock(return_value=-9)
+        monkeypatch.setattr("claude_runner.asyncio.create_subprocess_exec",
+                            AsyncMock(return_value=proc))
+
+        async def timed_out(coro, timeout):
+            coro.close()
+            raise asyncio.TimeoutError
+        monkeypatch.setattr("claude_runner.asyncio.wait_for", timed_out)
+
         reply = await runner.generate_reply("user@s.whatsapp.net", "Hello")
         # Should return an error message, not raise
-        assert isinstance(reply, str)
-        assert len(reply) > 0
+        assert "took too long" in reply
+        proc.kill.assert_called_once()
+        proc.wait.assert_awaited_once()
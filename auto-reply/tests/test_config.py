@@ -5,12 +5,17 @@ import os
 import pytest
 import yaml
 
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
 from config import load_config, AutoReplyConfig
 
 
 class TestConfigDefaults:
     def test_default_config_has_sane_values(self):
-        config = AutoReplyConfig()
+        config = AutoReplyConfig.model_construct()
         assert config.bridge.url == "http://localhost:8082/api"
         assert config.daemon.port == 8084
         assert config.claude.model == "claude-sonnet-4-5-20250929"
@@ -21,8 +26,12 @@ class TestConfigDefaults:
         assert config.security.block_groups is True
         assert config.security.rate_limit_seconds == 5.0
 
+    def test_constructed_defaults_match_validated_defaults(self):
+        # Guards the model_construct() shortcut used by the tests above
+        assert AutoReplyConfig.model_construct() == AutoReplyConfig()
+
     def test_default_security_has_empty_allowed_recipients(self):
-        config = AutoReplyConfig()
+        config = AutoReplyConfig.model_construct()
         assert config.security.allowed_recipients == []
 
 
@@ -34,7 +43,7 @@ class TestConfigFromYAML:
             "claude": {"model": "claude-haiku-4-5-20251001", "max_turns": 3},
         }
         config_file = tmp_path / "test_config.yaml"
-        config_file.write_text(yaml.dump(config_data))
+        config_file.write_text(yaml.dump(config_data, Dumper=SafeDumper))
 
         config = load_config(str(config_file))
         assert config.bridge.url == "http://custom:9999/api"
@@ -68,3 +77,8 @@ class TestConfigEnvOverrides:
         monkeypatch.setenv("WHATSAPP_MCP_ALLOWED_RECIPIENT", "  abc@s.whatsapp.net ,  def@lid  ")
         config = load_config(str(tmp_path / "missing.yaml"))
         assert config.security.allowed_recipients == ["abc@s.whatsapp.net", "def@lid"]
+
+    def test_allowed_recipients_skips_empty_entries(self, tmp_path, monkeypatch):
+        monkeypatch.setenv("WHATSAPP_MCP_ALLOWED_RECIPIENT", " , abc@s.whatsapp.net,,\tdef@lid ,")
+        config = load_config(str(tmp_path / "missing.yaml"))
+        assert config.security.allowed_recipients == ["abc@s.whatsapp.net", "def@lid"]
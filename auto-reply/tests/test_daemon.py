@@ -1,21 +1,36 @@
 # ABOUTME: Integration tests for the auto-reply daemon webhook handler.
 # ABOUTME: Tests the full webhook pipeline with mocked Claude runner and bridge.
 
-import json
+import os
+import time
 import asyncio
 import pytest
 import pytest_asyncio
-from unittest.mock import AsyncMock, MagicMock, patch
+import yaml
+from functools import lru_cache
+from unittest.mock import AsyncMock
 from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
 
-from daemon import AutoReplyDaemon
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
 
+from config import AutoReplyConfig, load_config
+from daemon import AutoReplyDaemon, WebhookPayload
 
-@pytest.fixture
-def config_dir(tmp_path):
-    """Create a temp config directory with all required files."""
-    import yaml
 
+@lru_cache(maxsize=32)
+def _cached_load(path: str, mtime: float) -> AutoReplyConfig:
+    # Keyed on mtime so a rewritten file is parsed again
+    return load_config(path)
+
+
+@pytest.fixture(scope="session")
+def config_dir(tmp_path_factory):
+    """Create a temp config directory with all required files, once per run."""
+    tmp_path = tmp_path_factory.mktemp("cfg")
     workspace = tmp_path / "workspace"
     workspace.mkdir()
     (workspace / "CLAUDE.md").write_text("Test assistant.")
@@ -38,23 +53,87 @@ def config_dir(tmp_path):
     }
 
     config_file = tmp_path / "config.yaml"
-    config_file.write_text(yaml.dump(config_data))
+    config_file.write_text(yaml.dump(config_data, Dumper=SafeDumper))
 
     return tmp_path, str(config_file)
 
 
 @pytest.fixture
-def daemon(config_dir, monkeypatch):
-    tmp_path, config_path = config_dir
+def isolated_config(config_dir) -> AutoReplyConfig:
+    """A private copy of the parsed config that a test may mutate freely."""
+    _, config_path = config_dir
+    config = _cached_load(config_path, os.path.getmtime(config_path))
+    return config.model_copy(deep=True)
+
+
+@pytest.fixture
+def daemon(config_dir, isolated_config, tmp_path, monkeypatch):
+    _, config_path = config_dir
+    # Per-test cwd keeps store/pairing.db out of the shared config dir
     monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr("daemon.load_config", lambda path: isolated_config)
     d = AutoReplyDaemon(config_path=config_path)
-    return d
+    yield d
+    d.pairing.close()
+
+
+@pytest_asyncio.fixture
+async def mock_bridge(daemon, aiohttp_server):
+    """Point the daemon's BridgeClient at a local fake bridge that records sends."""
+    sent = []
+
+    async def handle_send(request):
+        sent.append(await request.json())
+        return web.json_response({"success": True, "message": "Sent"})
+
+    app = web.Application()
+    app.router.add_post("/api/send", handle_send)
+    server = await aiohttp_server(app)
+    daemon.bridge.base_url = f"http://localhost:{server.port}/api"
+    yield sent
+    await daemon.bridge.aclose()
+
+
+@pytest.fixture(scope="module")
+def module_daemon(config_dir, tmp_path_factory):
+    """One daemon per module, shared by the tests that talk to it over HTTP."""
+    _, config_path = config_dir
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(tmp_path_factory.mktemp("served"))
+        mp.setattr("daemon.load_config",
+                   lambda path: _cached_load(path, os.path.getmtime(path)).model_copy(deep=True))
+        d = AutoReplyDaemon(config_path=config_path)
+        yield d
+    # Closing is idempotent, so this is safe after the app's own cleanup ran
+    d.pairing.close()
+
+
+@pytest_asyncio.fixture(scope="module", loop_scope="module")
+async def module_client(module_daemon):
+    async with TestServer(module_daemon.app) as server, TestClient(server) as client:
+        yield client
+
+
+@pytest.fixture
+def served_daemon(module_daemon):
+    """The shared daemon with per-test state reset around each test."""
+    secret = module_daemon._webhook_secret
+    yield module_daemon
+    module_daemon._webhook_secret = secret
+    module_daemon._seen_ids.clear()
+    module_daemon._last_reply_mono.clear()
+
+
+@pytest.fixture
+def client(served_daemon, module_client):
+    return module_client
 
 
 class TestWebhookEndpoint:
-    @pytest.mark.asyncio
-    async def test_webhook_accepts_valid_payload(self, daemon, aiohttp_client):
-        client = await aiohttp_client(daemon.app)
+    @pytest.mark.asyncio(loop_scope="module")
+    async def test_webhook_accepts_valid_payload(self, served_daemon, client, monkeypatch):
+        monkeypatch.setattr(served_daemon.claude, "generate_reply", AsyncMock(return_value="Reply"))
+        monkeypatch.setattr(served_daemon.bridge, "send_chunked", AsyncMock(return_value=[(True, "Sent")]))
         payload = {
             "message_id": "msg-001",
             "sender_jid": "user@s.whatsapp.net",
@@ -68,9 +147,21 @@ class TestWebhookEndpoint:
         data = await resp.json()
         assert data["status"] == "accepted"
 
-    @pytest.mark.asyncio
-    async def test_webhook_rejects_invalid_json(self, daemon, aiohttp_client):
-        client = await aiohttp_client(daemon.app)
+    @pytest.mark.asyncio(loop_scope="module")
+    async def test_webhook_drops_duplicate_message_id(self, served_daemon, client, monkeypatch):
+        monkeypatch.setattr(served_daemon, "process_message", AsyncMock())
+        payload = {"message_id": "msg-dup", "sender_jid": "user@s.whatsapp.net", "content": "Hi"}
+
+        resp = await client.post("/webhook/message", json=payload)
+        assert (await resp.json())["status"] == "accepted"
+        resp = await client.post("/webhook/message", json=payload)
+        assert resp.status == 200
+        assert (await resp.json())["status"] == "duplicate"
+        await asyncio.sleep(0)
+        served_daemon.process_message.assert_awaited_once()
+
+    @pytest.mark.asyncio(loop_scope="module")
+    async def test_webhook_rejects_invalid_json(self, client):
         resp = await client.post(
             "/webhook/message",
             data="not json",
@@ -78,10 +169,19 @@ class TestWebhookEndpoint:
         )
         assert resp.status == 400
 
-    @pytest.mark.asyncio
-    async def test_webhook_secret_validation(self, daemon, aiohttp_client):
-        daemon._webhook_secret = "test-secret-123"
-        client = await aiohttp_client(daemon.app)
+    @pytest.mark.asyncio(loop_scope="module")
+    async def test_webhook_rejects_non_object_payload(self, client):
+        resp = await client.post("/webhook/message", json=["not", "an", "object"])
+        assert resp.status == 400
+
+    @pytest.mark.asyncio(loop_scope="module")
+    async def test_webhook_rejects_mistyped_field(self, client):
+        resp = await client.post("/webhook/message", json={"sender_jid": "x", "content": 42})
+        assert resp.status == 400
+
+    @pytest.mark.asyncio(loop_scope="module")
+    async def test_webhook_secret_validation(self, served_daemon, client):
+        served_daemon._webhook_secret = "test-secret-123"
 
         # Without secret
         payload = {"sender_jid": "user@s.whatsapp.net", "content": "Hi"}
@@ -107,30 +207,19 @@ class TestWebhookEndpoint:
 
 class TestMessageProcessing:
     @pytest.mark.asyncio
-    async def test_ignores_own_messages(self, daemon):
-        payload = {
-            "sender_jid": "me@s.whatsapp.net",
-            "content": "My own message",
-            "is_from_me": True,
-            "is_group": False,
-        }
-        await daemon.process_message(payload)
-
-    @pytest.mark.asyncio
-    async def test_blocks_group_messages(self, daemon):
-        payload = {
-            "sender_jid": "group@g.us",
-            "content": "Group message",
-            "is_from_me": False,
-            "is_group": True,
-        }
-        await daemon.process_message(payload)
+    @pytest.mark.parametrize("payload", [
+        {"sender_jid": "me@s.whatsapp.net", "content": "My own message", "is_from_me": True},
+        {"sender_jid": "group@g.us", "content": "Group message", "is_group": True},
+    ], ids=["own-message", "group-message"])
+    async def test_early_return_skips_reply(self, daemon, payload, monkeypatch):
+        monkeypatch.setattr(daemon.claude, "generate_reply", AsyncMock(return_value="Reply"))
+        await daemon.process_message(WebhookPayload(**payload))
+        daemon.claude.generate_reply.assert_not_awaited()
 
     @pytest.mark.asyncio
-    async def test_processes_valid_message(self, daemon):
-        # Patch Claude runner and bridge
+    async def test_processes_valid_message(self, daemon, mock_bridge):
+        # Patch Claude runner; the bridge is a real client against a fake server
         daemon.claude.generate_reply = AsyncMock(return_value="Test reply from Claude Code")
-        daemon.bridge.send_chunked = AsyncMock(return_value=[(True, "Sent")])
 
         payload = {
             "sender_jid": "user@s.whatsapp.net",
@@ -139,22 +228,23 @@ class TestMessageProcessing:
             "is_from_me": False,
             "is_group": False,
         }
-        await daemon.process_message(payload)
+        await daemon.process_message(WebhookPayload(**payload))
 
         # Claude runner should have been called with the message
-        daemon.claude.generate_reply.assert_called_once_with(
+        daemon.claude.generate_reply.assert_awaited_once_with(
             sender_jid="user@s.whatsapp.net",
             message="Hello, testing!",
             sender_name="Test User",
         )
 
-        # Bridge should have sent the response
-        daemon.bridge.send_chunked.assert_called_once()
+        # Bridge should have sent the response over HTTP
+        assert mock_bridge == [
+            {"recipient": "user@s.whatsapp.net", "message": "Test reply from Claude Code"},
+        ]
 
     @pytest.mark.asyncio
-    async def test_handles_media_message(self, daemon):
+    async def test_handles_media_message(self, daemon, mock_bridge):
         daemon.claude.generate_reply = AsyncMock(return_value="I see you sent an image!")
-        daemon.bridge.send_chunked = AsyncMock(return_value=[(True, "Sent")])
 
         payload = {
             "sender_jid": "user@s.whatsapp.net",
@@ -163,18 +253,81 @@ class TestMessageProcessing:
             "is_from_me": False,
             "is_group": False,
         }
-        await daemon.process_message(payload)
+        await daemon.process_message(WebhookPayload(**payload))
 
         # Claude runner should have received the media placeholder
-        call_args = daemon.claude.generate_reply.call_args
-        assert "[Sent a image message]" in call_args.kwargs.get("message", call_args[1].get("message", ""))
+        assert "[Sent a image message]" in daemon.claude.generate_reply.await_args.kwargs["message"]
+        assert [m["message"] for m in mock_bridge] == ["I see you sent an image!"]
 
 
-class TestHealthEndpoint:
+class TestRateLimiting:
+    @pytest.mark.asyncio
+    async def test_rate_limited_sender_is_skipped(self, daemon):
+        daemon.config.security.rate_limit_seconds = 60
+        daemon.claude.generate_reply = AsyncMock(return_value="Reply")
+        daemon._last_reply_mono["user@s.whatsapp.net"] = time.monotonic()
+
+        await daemon.process_message(WebhookPayload(
+            sender_jid="user@s.whatsapp.net",
+            content="Again?",
+        ))
+
+        daemon.claude.generate_reply.assert_not_awaited()
+
+
+class TestSenderBookkeeping:
     @pytest.mark.asyncio
-    async def test_health_returns_status(self, daemon, aiohttp_client):
-        daemon.bridge.health_check = AsyncMock(return_value=True)
-        client = await aiohttp_client(daemon.app)
+    async def test_prunes_idle_senders(self, daemon):
+        daemon._last_reply_mono["old@s.whatsapp.net"] = 0.0
+        daemon._last_reply_mono["new@s.whatsapp.net"] = 10_000.0
+
+        daemon._prune_idle_senders(now=10_000.0)
+
+        assert "old@s.whatsapp.net" not in daemon._last_reply_mono
+        assert "new@s.whatsapp.net" in daemon._last_reply_mono
+
+    @pytest.mark.asyncio
+    async def test_sender_lock_released_when_unused(self, daemon):
+        jid = "user@s.whatsapp.net"
+        async with daemon._sender_lock(jid):
+            assert daemon._sender_locks[jid][1] == 1
+        assert jid not in daemon._sender_locks
+
+    @pytest.mark.asyncio
+    async def test_sender_lock_serializes_and_counts_waiters(self, daemon):
+        jid = "user@s.whatsapp.net"
+        order = []
+
+        async def worker(tag):
+            async with daemon._sender_lock(jid):
+                order.append(f"{tag}-start")
+                await asyncio.sleep(0.01)
+                order.append(f"{tag}-end")
+
+        first = asyncio.create_task(worker("a"))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(worker("b"))
+        await asyncio.sleep(0)
+        assert daemon._sender_locks[jid][1] == 2
+
+        await asyncio.gather(first, second)
+        assert order == ["a-start", "a-end", "b-start", "b-end"]
+        assert jid not in daemon._sender_locks
+
+    @pytest.mark.asyncio
+    async def test_cleanup_waits_for_gc_task(self, daemon):
+        await daemon._on_startup(daemon.app)
+        task = daemon._gc_task
+        await asyncio.sleep(0)
+        await daemon._on_cleanup(daemon.app)
+        assert task.cancelled()
+        assert daemon._gc_task is None
+
+
+class TestHealthEndpoint:
+    @pytest.mark.asyncio(loop_scope="module")
+    async def test_health_returns_status(self, served_daemon, client, monkeypatch):
+        monkeypatch.setattr(served_daemon.bridge, "health_check", AsyncMock(return_value=True))
         resp = await client.get("/health")
         assert resp.status == 200
         data = await resp.json()
@@ -182,10 +335,9 @@ class TestHealthEndpoint:
         assert data["version"] == "0.2.0"
         assert "model" in data
 
-    @pytest.mark.asyncio
-    async def test_health_degraded_when_bridge_down(self, daemon, aiohttp_client):
-        daemon.bridge.health_check = AsyncMock(return_value=False)
-        client = await aiohttp_client(daemon.app)
+    @pytest.mark.asyncio(loop_scope="module")
+    async def test_health_degraded_when_bridge_down(self, served_daemon, client, monkeypatch):
+        monkeypatch.setattr(served_daemon.bridge, "health_check", AsyncMock(return_value=False))
         resp = await client.get("/health")
         data = await resp.json()
         assert data["status"] == "degraded"
@@ -1,7 +1,6 @@
 # ABOUTME: Tests for the pairing-based access control store.
 # ABOUTME: Covers the full contact lifecycle: unknown -> pending -> approved/blocked.
 
-import time
 import pytest
 from datetime import datetime, timedelta
 
@@ -9,9 +8,33 @@ from pairing import PairingStore, ContactStatus
 
 
 @pytest.fixture
-def store(tmp_path):
-    db_path = str(tmp_path / "test_pairing.db")
-    return PairingStore(db_path=db_path, code_expiry_minutes=1, code_length=6)
+def store():
+    store = PairingStore(db_path=":memory:", code_expiry_minutes=1, code_length=6)
+    yield store
+    store.close()
+
+
+class FakeClock:
+    def __init__(self, now: float = 1_700_000_000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def file_store(tmp_path):
+    store = PairingStore(db_path=str(tmp_path / "test_pairing.db"))
+    yield store
+    store.close()
 
 
 class TestCheckAccess:
@@ -41,6 +64,10 @@ class TestPairingCodeGeneration:
         assert code.isdigit()
         assert len(code) == 6
 
+    def test_small_draws_are_zero_padded(self, store, monkeypatch):
+        monkeypatch.setattr("pairing.secrets.randbelow", lambda n: 42)
+        assert store.generate_pairing_code("user@s.whatsapp.net") == "000042"
+
     def test_code_stored_in_contact(self, store):
         jid = "user@s.whatsapp.net"
         code = store.generate_pairing_code(jid, "Test User")
@@ -70,16 +97,20 @@ class TestPairingCodeApproval:
         result = store.approve_by_code("000000")
         assert result is None
 
-    def test_approve_by_expired_code_returns_none(self, tmp_path):
-        db_path = str(tmp_path / "expiry_test.db")
-        store = PairingStore(db_path=db_path, code_expiry_minutes=0, code_length=6)
+    def test_approve_by_expired_code_returns_none(self, clock):
+        store = PairingStore(db_path=":memory:", code_expiry_minutes=1, now_fn=clock)
         jid = "user@s.whatsapp.net"
         code = store.generate_pairing_code(jid)
-        # code_expiry_minutes=0 means it expires immediately
-        time.sleep(0.1)
+        clock.advance(61)
         result = store.approve_by_code(code)
         assert result is None
 
+    def test_code_valid_until_expiry(self, clock):
+        store = PairingStore(db_path=":memory:", code_expiry_minutes=1, now_fn=clock)
+        code = store.generate_pairing_code("user@s.whatsapp.net")
+        clock.advance(59)
+        assert store.approve_by_code(code) == "user@s.whatsapp.net"
+
     def test_approve_contact_directly_by_jid(self, store):
         jid = "vip@s.whatsapp.net"
         store.approve_contact(jid)
@@ -106,29 +137,172 @@ class TestContactBlocking:
 
 class TestListContacts:
     def test_list_all_contacts(self, store):
-        store.approve_contact("a@s.whatsapp.net")
-        store.generate_pairing_code("b@s.whatsapp.net")
+        store.bulk_seed([
+            ("a@s.whatsapp.net", ContactStatus.APPROVED),
+            ("b@s.whatsapp.net", ContactStatus.PENDING),
+        ])
         contacts = store.list_contacts()
         assert len(contacts) == 2
 
     def test_list_by_status_filter(self, store):
-        store.approve_contact("a@s.whatsapp.net")
-        store.generate_pairing_code("b@s.whatsapp.net")
+        store.bulk_seed([
+            ("a@s.whatsapp.net", ContactStatus.APPROVED),
+            ("b@s.whatsapp.net", ContactStatus.PENDING),
+        ])
         approved = store.list_contacts(ContactStatus.APPROVED)
         assert len(approved) == 1
         assert approved[0].jid == "a@s.whatsapp.net"
 
+    def test_bulk_seed_overwrites_and_invalidates_cache(self, store):
+        store.approve_contact("a@s.whatsapp.net")
+        assert store.check_access("a@s.whatsapp.net") == ContactStatus.APPROVED
+        store.bulk_seed([("a@s.whatsapp.net", ContactStatus.BLOCKED)])
+        assert store.check_access("a@s.whatsapp.net") == ContactStatus.BLOCKED
+
     def test_list_empty_when_no_contacts(self, store):
         contacts = store.list_contacts()
         assert contacts == []
 
+    def test_timestamps_decoded_as_datetimes(self, store):
+        store.generate_pairing_code("pending@s.whatsapp.net")
+        store.approve_contact("approved@s.whatsapp.net")
+        by_jid = {c.jid: c for c in store.list_contacts()}
+        assert isinstance(by_jid["pending@s.whatsapp.net"].code_expires_at, datetime)
+        assert by_jid["pending@s.whatsapp.net"].approved_at is None
+        assert isinstance(by_jid["approved@s.whatsapp.net"].approved_at, datetime)
+
+    def test_legacy_empty_approved_at_decodes_as_none(self, store):
+        with store._write() as conn:
+            conn.execute("INSERT INTO contacts (jid, status, approved_at) VALUES ('a', 'approved', '')")
+        assert store.get_contact("a").approved_at is None
+
+    def test_does_not_replace_global_sqlite_converters(self, store):
+        import sqlite3
+        assert sqlite3.converters["TIMESTAMP"].__qualname__.startswith("register_adapters_and_converters")
+
 
 class TestExpiredCodeReset:
-    def test_expired_code_resets_to_unknown(self, tmp_path):
-        db_path = str(tmp_path / "expiry_reset.db")
-        store = PairingStore(db_path=db_path, code_expiry_minutes=0, code_length=6)
+    def test_expired_code_resets_to_unknown(self, clock):
+        store = PairingStore(db_path=":memory:", code_expiry_minutes=1, now_fn=clock)
         jid = "user@s.whatsapp.net"
         store.generate_pairing_code(jid)
-        time.sleep(0.1)
+        assert store.check_access(jid) == ContactStatus.PENDING
+        clock.advance(61)
         status = store.check_access(jid)
         assert status == ContactStatus.UNKNOWN
+
+
+class TestConnectionPool:
+    @pytest.mark.slow
+    def test_file_db_uses_wal(self, file_store):
+        with file_store._read() as conn:
+            assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    @pytest.mark.slow
+    def test_reads_see_committed_writes(self, file_store):
+        jid = "user@s.whatsapp.net"
+        file_store.approve_contact(jid)
+        # Repeated reads rotate through pooled connections
+        for _ in range(4):
+            assert file_store.get_contact(jid).status == ContactStatus.APPROVED
+
+    def test_failed_write_rolls_back(self, store):
+        with pytest.raises(RuntimeError):
+            with store._write() as conn:
+                conn.execute("INSERT INTO contacts (jid, status) VALUES ('x', 'approved')")
+                raise RuntimeError("boom")
+        assert store.get_contact("x").status == ContactStatus.UNKNOWN
+
+    def test_memory_db_shares_writer_for_reads(self, store):
+        store.approve_contact("user@s.whatsapp.net")
+        assert store.check_access("user@s.whatsapp.net") == ContactStatus.APPROVED
+
+
+class TestStatusCache:
+    def test_settled_status_served_from_cache(self, store, monkeypatch):
+        jid = "user@s.whatsapp.net"
+        store.approve_contact(jid)
+        assert store.check_access(jid) == ContactStatus.APPROVED
+        # Hits inside the TTL window answer from memory without touching SQLite
+        monkeypatch.setattr(store._pool, "read", lambda: pytest.fail("hit SQLite"))
+        monkeypatch.setattr(store._pool, "data_version", lambda: pytest.fail("hit SQLite"))
+        assert store.check_access(jid) == ContactStatus.APPROVED
+
+    def test_mutations_invalidate_cache(self, store):
+        jid = "user@s.whatsapp.net"
+        store.approve_contact(jid)
+        assert store.check_access(jid) == ContactStatus.APPROVED
+        store.block_contact(jid)
+        assert store.check_access(jid) == ContactStatus.BLOCKED
+
+    def test_approve_by_code_invalidates_cache(self, store):
+        jid = "user@s.whatsapp.net"
+        assert store.check_access(jid) == ContactStatus.UNKNOWN
+        code = store.generate_pairing_code(jid)
+        assert store.check_access(jid) == ContactStatus.PENDING
+        store.approve_by_code(code)
+        assert store.check_access(jid) == ContactStatus.APPROVED
+
+    @pytest.mark.slow
+    def test_commit_from_another_process_seen_after_ttl(self, file_store, monkeypatch):
+        import pairing
+        jid = "user@s.whatsapp.net"
+        file_store.approve_contact(jid)
+        assert file_store.check_access(jid) == ContactStatus.APPROVED
+        # The pairing CLI opens its own store on the same database
+        cli = PairingStore(db_path=file_store.db_path)
+        cli.block_contact(jid)
+        cli.close()
+        assert file_store.check_access(jid) == ContactStatus.APPROVED
+        monkeypatch.setattr(pairing, "STATUS_CACHE_TTL_SECONDS", 0.0)
+        assert file_store.check_access(jid) == ContactStatus.BLOCKED
+
+    def test_pending_status_not_cached(self, store):
+        jid = "user@s.whatsapp.net"
+        store.generate_pairing_code(jid)
+        store.check_access(jid)
+        assert jid not in store._status_cache
+
+    @pytest.mark.slow
+    def test_unchanged_database_keeps_cache_after_ttl(self, file_store, monkeypatch):
+        import pairing
+        jid = "user@s.whatsapp.net"
+        file_store.approve_contact(jid)
+        file_store.check_access(jid)
+        monkeypatch.setattr(pairing, "STATUS_CACHE_TTL_SECONDS", 0.0)
+        monkeypatch.setattr(file_store._pool, "read", lambda: pytest.fail("re-read status"))
+        assert file_store.check_access(jid) == ContactStatus.APPROVED
+
+
+class TestExpiryMigration:
+    @pytest.mark.slow
+    def test_legacy_iso_expiry_backfilled_to_epoch(self, tmp_path):
+        import sqlite3
+        db_path = str(tmp_path / "legacy.db")
+        expires_at = datetime.now() + timedelta(minutes=5)
+        conn = sqlite3.connect(db_path)
+        conn.execute("""
+            CREATE TABLE contacts (
+                jid TEXT PRIMARY KEY,
+                status TEXT NOT NULL DEFAULT 'unknown',
+                pairing_code TEXT,
+                code_expires_at TIMESTAMP,
+                approved_at TIMESTAMP,
+                name TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.execute(
+            "INSERT INTO contacts (jid, status, pairing_code, code_expires_at) VALUES (?, 'pending', '123456', ?)",
+            ("user@s.whatsapp.net", expires_at.isoformat()),
+        )
+        conn.commit()
+        conn.close()
+
+        store = PairingStore(db_path=db_path)
+        contact = store.get_contact("user@s.whatsapp.net")
+        assert abs((contact.code_expires_at - expires_at).total_seconds()) < 1
+        assert store.check_access("user@s.whatsapp.net") == ContactStatus.PENDING
+        assert store.approve_by_code("123456") == "user@s.whatsapp.net"
+        store.close()
@@ -0,0 +1,397 @@
+# ABOUTME: Tests for the per-sender session manager.
+# ABOUTME: Covers transcript storage, metadata persistence, compaction and reset.
+
+import asyncio
+import io
+import pytest
+
+from sessions import SessionManager, SessionMessage, estimate_tokens, now_us
+
+
+def _msg(content: str, role: str = "user") -> SessionMessage:
+    return SessionMessage(role=role, content=content)
+
+
+@pytest.fixture
+async def manager(tmp_path):
+    mgr = SessionManager(storage_dir=str(tmp_path / "sessions"), flush_interval=0.01)
+    yield mgr
+    await mgr.aclose()
+
+
+class TestTranscripts:
+    async def test_messages_round_trip(self, manager):
+        key = await manager.get_or_create_session("user@s.whatsapp.net", "Alice")
+        await manager.add_message(key, _msg("hi"))
+        await manager.add_message(key, _msg("hello", role="assistant"))
+        history = await manager.get_history(key)
+        assert [m.content for m in history] == ["hi", "hello"]
+        assert await manager.get_history_as_api_messages(key) == [
+            {"role": "user", "content": "hi"},
+            {"role": "assistant", "content": "hello"},
+        ]
+
+    async def test_compaction_keeps_recent_suffix(self, manager):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_messages(key, [_msg(t) for t in ("a" * 400, "b" * 400, "recent")])
+        # Summary (2) + "recent" (2) + one 100-token message fit; the oldest does not
+        manager.compaction_target_tokens = 104
+        await manager.compact_session(key, "summary")
+        assert await manager.get_history_as_api_messages(key) == [
+            {"role": "user", "content": "[Previous conversation summary: summary]"},
+            {"role": "user", "content": "b" * 400},
+            {"role": "user", "content": "recent"},
+        ]
+
+    async def test_compaction_truncates_boundary_message(self, manager):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("a" * 200 + "b" * 200))
+        manager.compaction_target_tokens = 22
+        await manager.compact_session(key, "summary")
+        summary, truncated = await manager.get_history(key)
+        assert summary.type == "compaction"
+        assert truncated.content.startswith("a") and truncated.content.endswith("b")
+        assert " … " in truncated.content
+        assert summary.token_count + truncated.token_count <= 22
+
+    async def test_compaction_prunes_markers_and_adjacent_repeats(self, manager):
+        manager.dedup_consecutive = False
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("hi"))
+        await manager.compact_session(key, "first")
+        await manager.add_messages(key, [_msg(t) for t in ("ok", "ok", "question", "ok")])
+        await manager.compact_session(key, "second")
+        # The non-adjacent "ok" is a separate turn and survives
+        assert [(m.type, m.content) for m in await manager.get_history(key)] == [
+            ("compaction", "second"), (None, "hi"), (None, "ok"), (None, "question"), (None, "ok"),
+        ]
+
+    async def test_pruning_can_be_disabled(self, manager):
+        manager.prune_before_compact = False
+        manager.dedup_consecutive = False
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("hi"))
+        await manager.add_message(key, _msg("hi"))
+        await manager.compact_session(key, "summary")
+        assert [m.content for m in await manager.get_history(key)] == ["summary", "hi", "hi"]
+
+    async def test_failed_rewrite_keeps_old_transcript(self, manager, monkeypatch):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("hi"))
+        monkeypatch.setattr("sessions.orjson.dumps", lambda obj: pytest.fail("disk full"))
+        with pytest.raises(pytest.fail.Exception):
+            await manager.compact_session(key, "summary")
+        assert b'"hi"' in manager._session_path(key).read_bytes()
+
+    async def test_compaction_with_no_budget_keeps_only_summary(self, manager):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("x" * 400))
+        manager.compaction_target_tokens = 2
+        await manager.compact_session(key, "summary")
+        assert [m.type for m in await manager.get_history(key)] == ["compaction"]
+
+    async def test_reset_drops_metadata(self, manager):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.reset_session(key)
+        assert manager.get_all_sessions() == []
+
+    async def test_add_messages_appends_batch(self, manager):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.get_history(key)
+        manager.max_history_tokens = 150
+        assert not await manager.add_messages(key, [_msg("x" * 400)])
+        batch = [_msg("y" * 400), SessionMessage("user", "z", sender_name="Bob")]
+        assert await manager.add_messages(key, batch)
+        meta = manager.get_all_sessions()[0]
+        assert (meta.message_count, meta.estimated_tokens, meta.sender_name) == (3, 201, "Bob")
+        assert [m.content[0] for m in await manager.get_history(key)] == ["x", "y", "z"]
+        manager._history_cache.clear()
+        assert len(await manager.get_history(key)) == 3
+
+    async def test_session_keys_are_interned(self, manager, tmp_path):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        manager.flush()
+        fresh = SessionManager(storage_dir=str(tmp_path / "sessions"))
+        loaded = next(iter(fresh._metadata))
+        assert loaded is fresh.session_key_for_jid("user@s.whatsapp.net") is key
+        await fresh.aclose()
+
+    async def test_consecutive_duplicates_are_skipped(self, manager):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("hi"))
+        await manager.add_messages(key, [_msg("hi"), _msg("hi", role="assistant"), _msg("hi")])
+        assert [m.role for m in await manager.get_history(key)] == ["user", "assistant", "user"]
+        assert manager.get_all_sessions()[0].message_count == 3
+
+    async def test_duplicate_detection_survives_reload(self, manager, tmp_path):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("hi"))
+        manager.flush()
+        fresh = SessionManager(storage_dir=str(tmp_path / "sessions"))
+        await fresh.add_message(key, _msg("hi"))
+        assert len(await fresh.get_history(key)) == 1
+        await fresh.aclose()
+
+    async def test_records_have_no_instance_dict(self, manager):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        assert not hasattr(_msg("hi"), "__dict__")
+        assert not hasattr(manager._metadata[key], "__dict__")
+
+
+class TestMetadataFlush:
+    async def test_add_message_defers_metadata_write(self, manager):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("hi"))
+        assert not manager._metadata_log_path().exists()
+        manager.flush()
+        assert manager._metadata_log_path().stat().st_size > 0
+        assert not manager._metadata_path().exists()
+
+    async def test_flushed_metadata_reloads(self, manager, tmp_path):
+        key = await manager.get_or_create_session("user@s.whatsapp.net", "Alice")
+        await manager.add_message(key, _msg("hi"))
+        manager.flush()
+        reloaded = SessionManager(storage_dir=str(tmp_path / "sessions"))
+        assert reloaded.get_all_sessions()[0].sender_name == "Alice"
+        assert reloaded.get_all_sessions()[0].message_count == 1
+        await reloaded.aclose()
+
+    def test_unclosed_manager_is_not_pinned_by_exit_hook(self, tmp_path):
+        import gc
+        import weakref
+        mgr = SessionManager(storage_dir=str(tmp_path / "sessions"))
+        ref = weakref.ref(mgr)
+        del mgr
+        gc.collect()
+        assert ref() is None
+
+    async def test_background_flush_writes_dirty_metadata(self, manager):
+        await manager.get_or_create_session("user@s.whatsapp.net")
+        await asyncio.sleep(0.05)
+        assert manager._metadata_log_path().exists()
+        assert not manager._dirty_keys
+
+    async def test_aclose_flushes_pending_metadata(self, tmp_path):
+        mgr = SessionManager(storage_dir=str(tmp_path / "sessions"), flush_interval=60)
+        await mgr.get_or_create_session("user@s.whatsapp.net")
+        await mgr.aclose()
+        assert mgr._metadata_log_path().exists()
+
+
+class TestMetadataLog:
+    async def test_flush_appends_only_changed_sessions(self, manager):
+        keys = [await manager.get_or_create_session(f"user{i}@s.whatsapp.net") for i in range(3)]
+        manager.flush()
+        size = manager._metadata_log_path().stat().st_size
+        await manager.add_message(keys[0], _msg("hi"))
+        manager.flush()
+        # One more upsert record, not a rewrite of all three sessions
+        assert size < manager._metadata_log_path().stat().st_size < size * 2
+
+    async def test_unchanged_sessions_are_not_rewritten(self, manager):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        manager.flush()
+        size = manager._metadata_log_path().stat().st_size
+        manager._mark_dirty(key)
+        manager.flush()
+        assert manager._metadata_log_path().stat().st_size == size
+
+    async def test_replay_applies_upserts_and_deletes(self, manager, tmp_path):
+        kept = await manager.get_or_create_session("kept@s.whatsapp.net")
+        dropped = await manager.get_or_create_session("dropped@s.whatsapp.net")
+        manager.flush()
+        await manager.add_message(kept, _msg("hi"))
+        await manager.reset_session(dropped)
+        manager.flush()
+        reloaded = SessionManager(storage_dir=str(tmp_path / "sessions"))
+        assert [m.session_key for m in reloaded.get_all_sessions()] == [kept]
+        assert reloaded.get_all_sessions()[0].message_count == 1
+        # Startup folds the log into the snapshot
+        assert reloaded._metadata_path().exists()
+        assert not reloaded._metadata_log_path().exists()
+        await reloaded.aclose()
+
+    async def test_torn_trailing_record_ignored(self, manager, tmp_path):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        manager.flush()
+        with open(manager._metadata_log_path(), "ab") as f:
+            f.write(b"\x01\xff\x00\x00\x00{")
+        reloaded = SessionManager(storage_dir=str(tmp_path / "sessions"))
+        assert [m.session_key for m in reloaded.get_all_sessions()] == [key]
+        await reloaded.aclose()
+
+    async def test_large_log_rotates_into_snapshot(self, manager, monkeypatch):
+        import sessions
+        monkeypatch.setattr(sessions, "METADATA_LOG_ROTATE_BYTES", 0)
+        await manager.get_or_create_session("user@s.whatsapp.net")
+        manager.flush()
+        assert manager._metadata_path().exists()
+        assert not manager._metadata_log_path().exists()
+
+
+class TestTranscriptHandles:
+    async def test_handle_reused_across_appends(self, manager):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("one"))
+        handle = manager._handles[key]
+        await manager.add_message(key, _msg("two"))
+        assert manager._handles[key] is handle
+        assert [m.content for m in await manager.get_history(key)] == ["one", "two"]
+
+    async def test_least_recent_handle_evicted(self, manager, monkeypatch):
+        import sessions
+        monkeypatch.setattr(sessions, "MAX_OPEN_TRANSCRIPTS", 2)
+        keys = [await manager.get_or_create_session(f"user{i}@s.whatsapp.net") for i in range(3)]
+        for key in keys:
+            await manager.add_message(key, _msg("hi"))
+        assert list(manager._handles) == keys[1:]
+        assert (await manager.get_history(keys[0]))[0].content == "hi"
+
+    async def test_compaction_reopens_handle(self, manager):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("old"))
+        await manager.compact_session(key, "summary")
+        assert key not in manager._handles
+        await manager.add_message(key, _msg("new"))
+        assert [m.content for m in await manager.get_history(key)] == ["summary", "old", "new"]
+
+    async def test_appends_are_buffered_and_flushed(self, manager):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("hi"))
+        # A buffered writer never reports a short write, unlike raw FileIO
+        assert not isinstance(manager._handles[key]._file, io.FileIO)
+        assert b'"hi"' in manager._session_path(key).read_bytes()
+
+    async def test_aclose_closes_handles(self, manager):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("hi"))
+        handle = manager._handles[key]
+        await manager.aclose()
+        assert handle.closed
+        assert manager._handles == {}
+
+
+class TestHistoryCache:
+    async def test_history_not_reparsed_after_first_read(self, manager, monkeypatch):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("one"))
+        await manager.get_history(key)
+
+        def fail_open(*args, **kwargs):
+            raise AssertionError("transcript re-read from disk")
+        monkeypatch.setattr("sessions.aiofiles.open", fail_open)
+        await manager.add_message(key, _msg("two"))
+        assert [m.content for m in await manager.get_history(key)] == ["one", "two"]
+
+    async def test_cold_start_loads_from_disk(self, manager, tmp_path):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("persisted"))
+        fresh = SessionManager(storage_dir=str(tmp_path / "sessions"))
+        assert [m.content for m in await fresh.get_history(key)] == ["persisted"]
+        await fresh.aclose()
+
+    async def test_reset_replaces_cached_history(self, manager):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("old"))
+        await manager.get_history(key)
+        await manager.reset_session(key, reason="test")
+        history = await manager.get_history(key)
+        assert [m.type for m in history] == ["reset"]
+
+    async def test_api_messages_extended_on_append(self, manager, monkeypatch):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("one"))
+        await manager.get_history_as_api_messages(key)
+        monkeypatch.setattr("sessions._api_message", lambda msg: {"role": "user", "content": "tail"})
+        await manager.add_message(key, _msg("two"))
+        # Only the appended message goes through conversion again
+        assert await manager.get_history_as_api_messages(key) == [
+            {"role": "user", "content": "one"},
+            {"role": "user", "content": "tail"},
+        ]
+        await manager.compact_session(key, "summary")
+        # Compaction rewrites history, so every message is converted afresh
+        assert await manager.get_history_as_api_messages(key) == [
+            {"role": "user", "content": "tail"},
+        ] * 3
+
+    async def test_api_messages_do_not_copy_history(self, manager, monkeypatch):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("one"))
+        monkeypatch.setattr(manager, "get_history", lambda key: pytest.fail("copied history"))
+        assert await manager.get_history_as_api_messages(key) == [{"role": "user", "content": "one"}]
+
+    async def test_returned_history_is_a_copy(self, manager):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("one"))
+        (await manager.get_history(key)).clear()
+        assert len(await manager.get_history(key)) == 1
+
+
+class TestTokenEstimate:
+    def test_ascii_text_is_about_four_chars_per_token(self):
+        assert estimate_tokens("x" * 400) == 100
+
+    def test_non_ascii_counts_per_character(self):
+        assert estimate_tokens("こんにちは") == 5
+        assert estimate_tokens("ok 👍") == 2
+
+    def test_empty_text_is_zero(self):
+        assert estimate_tokens("") == 0
+
+    def test_estimate_does_not_retain_message_bodies(self):
+        # token_count is computed once per message, so there is nothing to memoize
+        assert not hasattr(estimate_tokens, "cache_info")
+
+    async def test_metadata_uses_estimate(self, manager):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("🎉" * 10))
+        assert manager.get_all_sessions()[0].estimated_tokens == 10
+
+    def test_message_caches_its_token_count(self):
+        msg = _msg("x" * 40)
+        assert msg.token_count == 10
+
+    async def test_token_count_survives_reload(self, manager, tmp_path, monkeypatch):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("x" * 40))
+        fresh = SessionManager(storage_dir=str(tmp_path / "sessions"))
+        monkeypatch.setattr("sessions.estimate_tokens", lambda text: pytest.fail("re-estimated"))
+        assert (await fresh.get_history(key))[0].token_count == 10
+        await fresh.aclose()
+
+    async def test_compaction_recomputes_running_total(self, manager):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        await manager.add_message(key, _msg("x" * 400))
+        await manager.add_message(key, _msg("x" * 400))
+        manager.compaction_target_tokens = 110
+        await manager.compact_session(key, "y" * 40)
+        assert manager.get_all_sessions()[0].estimated_tokens == 110
+
+
+class TestTimestamps:
+    def test_timestamp_defaults_to_now(self):
+        before = now_us()
+        assert before <= _msg("hi").timestamp <= now_us()
+
+    async def test_idle_session_is_reset(self, manager):
+        key = await manager.get_or_create_session("user@s.whatsapp.net")
+        manager._metadata[key].last_activity = now_us() - 61 * 60_000_000
+        assert await manager.get_or_create_session("user@s.whatsapp.net") == key
+        assert manager._metadata[key].message_count == 0
+        assert (await manager.get_history(key)) == []
+
+    async def test_legacy_iso_strings_are_converted(self, tmp_path):
+        storage = tmp_path / "sessions"
+        storage.mkdir()
+        (storage / "metadata.json").write_text(
+            '{"whatsapp:user": {"session_key": "whatsapp:user", '
+            '"last_activity": "2024-01-01T12:00:00", "created_at": "2024-01-01T11:00:00"}}')
+        (storage / "whatsapp_user.jsonl").write_text(
+            '{"role": "user", "content": "hi", "timestamp": "2024-01-01T12:00:00"}\n')
+        mgr = SessionManager(storage_dir=str(storage))
+        meta = mgr.get_all_sessions()[0]
+        assert meta.last_activity - meta.created_at == 3600 * 1_000_000
+        history = await mgr.get_history("whatsapp:user")
+        assert history[0].timestamp == meta.last_activity
+        await mgr.aclose()